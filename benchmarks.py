@@ -0,0 +1,698 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from werkzeug.serving import make_server
+
+from client import FINAL_ERRORS, RaftClient, RaftClientError, ShardedClient
+from server import FrameCodec, RaftLog, RaftServer, WriteAheadLog
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def legacy_key_version(log, key):
+    # the pre-index read path: reverse copy + linear scan
+    i = 0
+    for el in log[::-1]:
+        if key == el["key"]:
+            return len(log) - i
+        i += 1
+    return -1
+
+
+def standalone_leader():
+    server = RaftServer(1, data_dir=None)
+    server.state = "leader"
+    server.leader_id = 1
+    # no peers to confirm reads with
+    server.confirmed_at = float("inf")
+    return server
+
+
+def bench_log_memory(entries, value_size, output):
+    """Bytes per put entry: the log as a list of entry dicts (as they come
+    off the wire) vs RaftLog, and everything a standalone server holds
+    once it has appended and applied them."""
+    def entry(i):
+        return json.loads(json.dumps({"type": "put", "key": f"key-{i}", "value": str(i).rjust(value_size, "v"), "term": 1}))
+
+    def traced(build):
+        gc.collect()
+        tracemalloc.start()
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return size / entries
+
+    def server():
+        leader = standalone_leader()
+        for i in range(entries):
+            leader.append_entry(entry(i))
+        leader.commit_index = len(leader.log)
+        leader.apply_committed()
+        return leader
+
+    def raft_log():
+        log = RaftLog()
+        for i in range(entries):
+            log.append(entry(i))
+        return log
+
+    result = {
+        "bench": "log-memory",
+        "time": time.time(),
+        "config": {"entries": entries, "value_size": value_size},
+        "dict_list_bytes_per_entry": traced(lambda: [entry(i) for i in range(entries)]),
+        "raft_log_bytes_per_entry": traced(raft_log),
+        "server_bytes_per_entry": traced(server),
+    }
+    print(json.dumps(result, indent=2))
+    write_result(output, result)
+
+
+def bench_read_path(sizes, reads):
+    server = standalone_leader()
+    client = server.app.test_client()
+
+    # the key we read is written first, so the legacy scan has to walk the whole log
+    server.append_entry({"type": "put", "key": "hot", "value": "v"})
+    server.change_log["hot"] = "v"
+
+    print(f"{'log size':>12} {'p50 us':>10} {'p99 us':>10} {'legacy scan us':>16}")
+    for size in sizes:
+        while len(server.log) < size:
+            key = f"k{len(server.log)}"
+            server.append_entry({"type": "put", "key": key, "value": "x"})
+            server.change_log[key] = "x"
+
+        samples = []
+        for _ in range(reads):
+            start = time.perf_counter()
+            response = client.get("/get_data", json={"key": "hot"})
+            samples.append(time.perf_counter() - start)
+            assert response.status_code in (200, 302)
+
+        start = time.perf_counter()
+        legacy_key_version(server.log, "hot")
+        legacy = time.perf_counter() - start
+
+        print(
+            f"{size:>12} {percentile(samples, 0.5) * 1e6:>10.1f} "
+            f"{percentile(samples, 0.99) * 1e6:>10.1f} {legacy * 1e6:>16.1f}"
+        )
+
+
+def bench_wal(modes, writers, writes, value_size):
+    value = "x" * value_size
+    print(f"{'mode':>10} {'writes/s':>10} {'fsyncs':>8} {'recover s':>10} {'MB':>8}")
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, "bench.wal")
+            wal = WriteAheadLog(path, sync_mode=mode)
+            wal.open()
+
+            def writer(n):
+                # what put_data does on the leader: append, then wait for the group fsync
+                for i in range(writes):
+                    wal.append({"op": "append", "entry": {"type": "put", "key": f"k{n}-{i}", "value": value, "term": 1}})
+                    wal.sync()
+
+            threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            wal.file.flush()
+            os.fsync(wal.file.fileno())
+
+            start = time.perf_counter()
+            server = RaftServer(1, data_dir=None)
+            server.wal = WriteAheadLog(path)
+            server.recover()
+            recover = time.perf_counter() - start
+            assert len(server.log) == writers * writes
+
+            print(
+                f"{mode:>10} {writers * writes / elapsed:>10.0f} {wal.fsyncs:>8} "
+                f"{recover:>10.3f} {os.path.getsize(path) / 2**20:>8.1f}"
+            )
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def bench_wire(sizes, value_size):
+    print(f"{'entries':>8} {'format':>6} {'encode us':>11} {'decode us':>11} {'bytes':>10}")
+    for size in sizes:
+        message = {
+            "leader_id": 1,
+            "term": 7,
+            "prev_log_index": 1000,
+            "prev_log_term": 7,
+            "entries": [
+                {"type": "put", "key": f"user:{i}", "value": f"{i}:" + "v" * value_size, "term": 7}
+                for i in range(size)
+            ],
+            "leader_commit": 999,
+        }
+        repeat = max(3, 20000 // size)
+        # what requests.post(json=...) and request.get_json() do
+        encoded = [
+            ("json", lambda: json.dumps(message, allow_nan=False).encode(), json.loads),
+            ("frame", lambda: FrameCodec.encode(message), FrameCodec.decode),
+        ]
+        for name, encode, decode in encoded:
+            encode_time, data = timed(encode, repeat)
+            decode_time, decoded = timed(lambda: decode(data), repeat)
+            assert decoded == message
+            print(f"{size:>8} {name:>6} {encode_time * 1e6:>11.1f} {decode_time * 1e6:>11.1f} {len(data):>10}")
+
+
+def serve_runtime(runtime, port):
+    server = standalone_leader()
+    server.append_entry({"type": "put", "key": "hot", "value": "v"})
+    server.change_log["hot"] = "v"
+    if runtime == "async":
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.serve_async("127.0.0.1", port))
+        loop.run_forever()
+    else:
+        # what app.run(threaded=True) does
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        make_server("127.0.0.1", port, server.app, threaded=True).serve_forever()
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def bench_runtime(runtimes, clients, requests_per_client, port):
+    print(f"{'runtime':>9} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for runtime in runtimes:
+        process = multiprocessing.Process(target=serve_runtime, args=(runtime, port), daemon=True)
+        process.start()
+        try:
+            wait_for_port(port)
+            for concurrency in clients:
+                def worker(_):
+                    samples, errors = [], 0
+                    with requests.Session() as session:
+                        for _ in range(requests_per_client):
+                            start = time.perf_counter()
+                            try:
+                                session.get(f"http://127.0.0.1:{port}/get_data", json={"key": "hot"}, timeout=30)
+                            except requests.RequestException:
+                                errors += 1
+                            samples.append(time.perf_counter() - start)
+                    return samples, errors
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    results = list(pool.map(worker, range(concurrency)))
+                elapsed = time.perf_counter() - start
+                samples = [sample for result, _ in results for sample in result]
+                errors = sum(errors for _, errors in results)
+                print(
+                    f"{runtime:>9} {concurrency:>8} {len(samples) / elapsed:>8.0f} "
+                    f"{percentile(samples, 0.5) * 1e3:>8.2f} {percentile(samples, 0.99) * 1e3:>8.2f} {errors:>7}"
+                )
+        finally:
+            process.terminate()
+            process.join()
+
+
+class LocalCluster:
+    """server.py processes on localhost ports, no Docker needed.
+
+    Each node gets its own WAL directory; extra env (SHARDS, RUNTIME, ...)
+    is passed to every node. Node logs go to <data_dir>/<id>.log.
+    """
+
+    def __init__(self, size=5, base_port=6000, env=None):
+        self.addresses = {server_id: f"http://127.0.0.1:{base_port + server_id}" for server_id in range(1, size + 1)}
+        self.env = dict(env or {})
+        self.processes = {}
+
+
+    def __enter__(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        for server_id in self.addresses:
+            self.start(server_id)
+        for url in self.addresses.values():
+            wait_for_port(urlparse(url).port)
+        return self
+
+
+    def __exit__(self, *exc):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.wait()
+        self.data_dir.cleanup()
+
+
+    def start(self, server_id):
+        env = dict(
+            os.environ,
+            SERVER_ID=str(server_id),
+            SERVER_ADDRESSES=",".join(f"{peer_id}={url}" for peer_id, url in self.addresses.items()),
+            WAL_DIR=self.data_dir.name,
+            LOG_LEVEL="WARNING"
+        )
+        env.update(self.env)
+        with open(os.path.join(self.data_dir.name, f"{server_id}.log"), "ab") as log:
+            self.processes[server_id] = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=log
+            )
+
+
+    def statuses(self, server_ids=None):
+        for server_id in server_ids or self.addresses:
+            try:
+                yield server_id, requests.get(f"{self.addresses[server_id]}/status", timeout=1).json()
+            except requests.RequestException:
+                continue
+
+
+    def wait_for_leader(self, among=None, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for server_id, status in self.statuses(among):
+                if status.get("state") == "leader" and status.get("alive", True):
+                    return server_id
+            time.sleep(0.05)
+        raise RuntimeError(f"no leader elected in {timeout}s")
+
+
+def write_result(output, result):
+    """Append one JSON line per run, so runs can be compared later."""
+    if output:
+        with open(output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+def run_op(client, known, op, key, scheduled):
+    """Do one op and return (op, latency from its scheduled start, outcome)."""
+    value = random.randrange(1 << 30)
+    try:
+        if op == "put":
+            client.put(key, value)
+            known[key] = value
+        elif op == "get":
+            client.get(key)
+        elif op == "patch":
+            client.update(key, value, known.get(key))
+            known[key] = value
+        elif op == "delete":
+            client.delete(key)
+            known.pop(key, None)
+        outcome = "ok"
+    except RaftClientError as e:
+        # a lost compare-and-set or a missing key is an answer, not a failure
+        outcome = "rejected" if str(e) in FINAL_ERRORS else "error"
+    return op, time.perf_counter() - scheduled, outcome
+
+
+def bench_load(size, mix, rate, duration, keys, workers, base_port, output):
+    """Open loop: ops are started on a fixed schedule whether or not earlier
+    ones finished, and latency counts from the scheduled start, so a stall
+    shows up in the tail instead of slowing the load down."""
+    weights = dict(part.split("=") for part in mix.split(","))
+    ops, weights = list(weights), [float(weight) for weight in weights.values()]
+    rng = random.Random(0)
+
+    with LocalCluster(size, base_port) as cluster:
+        cluster.wait_for_leader()
+        client = RaftClient(cluster.addresses, pool_size=workers, retry_timeout=5)
+        known = {}
+        for i in range(keys):
+            client.put(f"key-{i}", 0)
+            known[f"key-{i}"] = 0
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        start = time.perf_counter()
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            op = rng.choices(ops, weights)[0]
+            futures.append(pool.submit(run_op, client, known, op, f"key-{rng.randrange(keys)}", scheduled))
+        samples = defaultdict(list)
+        outcomes = defaultdict(lambda: defaultdict(int))
+        for future in futures:
+            op, latency, outcome = future.result()
+            samples[op].append(latency)
+            outcomes[op][outcome] += 1
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+
+    result = {
+        "bench": "load",
+        "time": time.time(),
+        "config": {"nodes": size, "mix": mix, "rate": rate, "duration": duration, "keys": keys, "workers": workers},
+        "throughput": sum(outcomes[op]["ok"] + outcomes[op]["rejected"] for op in outcomes) / elapsed,
+        "ops": {
+            op: {
+                "count": len(samples[op]),
+                "ok": outcomes[op]["ok"],
+                "rejected": outcomes[op]["rejected"],
+                "errors": outcomes[op]["error"],
+                "p50_ms": percentile(samples[op], 0.5) * 1e3,
+                "p99_ms": percentile(samples[op], 0.99) * 1e3,
+                "p999_ms": percentile(samples[op], 0.999) * 1e3,
+            }
+            for op in sorted(samples)
+        },
+    }
+    print(f"target {rate:.0f} ops/s, achieved {result['throughput']:.0f} ops/s")
+    print(f"{'op':>7} {'count':>7} {'rejected':>9} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}")
+    for op, stats in result["ops"].items():
+        print(
+            f"{op:>7} {stats['count']:>7} {stats['rejected']:>9} {stats['errors']:>7} "
+            f"{stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['p999_ms']:>8.2f}"
+        )
+    write_result(output, result)
+
+
+def bench_failover(size, rounds, base_port, output, timers=None):
+    """Turn the leader off and time until another node leads and until a
+    write commits again, then turn it back on for the next round. timers
+    sets ELECTION_TIMEOUT_MIN_MS, ELECTION_TIMEOUT_MAX_MS and
+    HEARTBEAT_INTERVAL_MS on every node."""
+    timers = {name: str(value) for name, value in (timers or {}).items()}
+    rounds_result = []
+    print(f"{'round':>6} {'elected s':>10} {'write s':>8}")
+    with LocalCluster(size, base_port, env=timers) as cluster:
+        client = RaftClient(cluster.addresses, retry_timeout=120)
+        for round_ in range(rounds):
+            leader = cluster.wait_for_leader()
+            client.put("failover", round_)
+            others = [server_id for server_id in cluster.addresses if server_id != leader]
+
+            started = time.perf_counter()
+            requests.get(f"{cluster.addresses[leader]}/turnoff", timeout=1)
+            cluster.wait_for_leader(among=others, timeout=120)
+            elected = time.perf_counter() - started
+            client.put("failover", round_ + 1)
+            written = time.perf_counter() - started
+
+            print(f"{round_:>6} {elected:>10.2f} {written:>8.2f}")
+            rounds_result.append({"elected_s": elected, "write_s": written})
+            requests.get(f"{cluster.addresses[leader]}/turnon", timeout=1)
+            # let it rejoin as a follower before the next round
+            time.sleep(2)
+
+    write_result(output, {
+        "bench": "failover",
+        "time": time.time(),
+        "config": {"nodes": size, "rounds": rounds, **timers},
+        "rounds": rounds_result,
+        "elected_p50_s": percentile([r["elected_s"] for r in rounds_result], 0.5),
+        "write_max_s": max(r["write_s"] for r in rounds_result),
+    })
+
+
+def bench_sim_failover(size, runs, output):
+    """Failover time over many seeded runs of the simulator, in virtual
+    seconds, and the terms a server cut off for a minute and healed makes
+    the cluster go through."""
+    from simulator import Simulator
+
+    elected, terms = [], []
+    for seed in range(runs):
+        with Simulator(size, seed=seed) as sim:
+            leader = sim.run_until(sim.leader)
+            sim.crash(leader)
+            started = sim.clock.now
+            sim.run_until(lambda: sim.leader() not in (None, leader))
+            elected.append(sim.clock.now - started)
+
+            sim.restart(leader)
+            sim.run_until(lambda: sim.nodes[leader].state == "follower" and sim.nodes[leader].leader_id)
+            term = max(node.term for node in sim.nodes.values())
+            sim.partition({leader}, set(sim.nodes) - {leader})
+            sim.run_for(60)
+            sim.heal()
+            sim.run_for(10)
+            terms.append(max(node.term for node in sim.nodes.values()) - term)
+
+    result = {
+        "bench": "sim-failover",
+        "time": time.time(),
+        "config": {"nodes": size, "runs": runs},
+        "elected_p50_s": percentile(elected, 0.5),
+        "elected_p99_s": percentile(elected, 0.99),
+        "elected_max_s": max(elected),
+        "terms_after_partition_max": max(terms),
+    }
+    print(json.dumps(result, indent=2))
+    write_result(output, result)
+
+
+def wait_for_leaders(addresses, shards, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        leaders = set()
+        for url in addresses.values():
+            try:
+                status = requests.get(f"{url}/status", timeout=1).json()
+            except requests.RequestException:
+                continue
+            leaders |= {group["shard"] for group in status["shards"] if group["state"] == "leader"}
+        if len(leaders) == shards:
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f"not every one of {shards} shards elected a leader")
+
+
+def bench_shards(shard_counts, writers, duration, base_port):
+    print(f"{'shards':>7} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for shards in shard_counts:
+        with LocalCluster(5, base_port, env={"SHARDS": str(shards)}) as cluster:
+            # SHARDS=1 runs a plain RaftServer, with no /shard routes
+            if shards == 1:
+                cluster.wait_for_leader()
+            else:
+                wait_for_leaders(cluster.addresses, shards)
+
+            def writer(n):
+                if shards == 1:
+                    client = RaftClient(cluster.addresses)
+                else:
+                    client = ShardedClient(cluster.addresses, shards)
+                samples, errors, i = [], 0, 0
+                deadline = time.perf_counter() + duration
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        client.put(f"w{n}-{i}", i)
+                    except Exception:
+                        errors += 1
+                    samples.append(time.perf_counter() - start)
+                    i += 1
+                return samples, errors
+
+            with ThreadPoolExecutor(max_workers=writers) as pool:
+                results = list(pool.map(writer, range(writers)))
+            samples = [sample for result, _ in results for sample in result]
+            errors = sum(errors for _, errors in results)
+            print(
+                f"{shards:>7} {(len(samples) - errors) / duration:>9.0f} "
+                f"{percentile(samples, 0.5) * 1e3:>8.2f} {percentile(samples, 0.99) * 1e3:>8.2f} {errors:>7}"
+            )
+
+
+def bench_cas(modes, workers, keys, value_size, duration, base_port, output):
+    """Read-modify-write loops on a few hot keys: compare-and-set on the old
+    value (which ships and compares the whole value) vs on the revision."""
+    print(f"{'mode':>9} {'cas/s':>7} {'conflicts/s':>12} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for mode in modes:
+        with LocalCluster(5, base_port) as cluster:
+            cluster.wait_for_leader()
+            setup = RaftClient(cluster.addresses)
+            for k in range(keys):
+                setup.put(f"hot-{k}", "x" * value_size)
+
+            def worker(n):
+                client = RaftClient(cluster.addresses)
+                samples, conflicts, errors = [], 0, 0
+                rng = random.Random(n)
+                deadline = time.perf_counter() + duration
+                while time.perf_counter() < deadline:
+                    key = f"hot-{rng.randrange(keys)}"
+                    new = str(rng.random()).ljust(value_size, "x")
+                    start = time.perf_counter()
+                    try:
+                        value, revision = client.get_revision(key)
+                        if mode == "revision":
+                            client.update(key, new, if_revision=revision)
+                        else:
+                            client.update(key, new, value)
+                        samples.append(time.perf_counter() - start)
+                    except RaftClientError as e:
+                        if str(e) in FINAL_ERRORS:
+                            conflicts += 1
+                        else:
+                            errors += 1
+                return samples, conflicts, errors
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(worker, range(workers)))
+            samples = [sample for result, _, _ in results for sample in result]
+            conflicts = sum(conflicts for _, conflicts, _ in results)
+            errors = sum(errors for _, _, errors in results)
+            print(
+                f"{mode:>9} {len(samples) / duration:>7.0f} {conflicts / duration:>12.0f} "
+                f"{percentile(samples, 0.5) * 1e3:>8.2f} {percentile(samples, 0.99) * 1e3:>8.2f} {errors:>7}"
+            )
+            write_result(output, {
+                "bench": "cas",
+                "time": time.time(),
+                "config": {"mode": mode, "workers": workers, "keys": keys, "value_size": value_size},
+                "cas_per_s": len(samples) / duration,
+                "conflicts_per_s": conflicts / duration,
+                "p50_s": percentile(samples, 0.5),
+                "p99_s": percentile(samples, 0.99),
+                "errors": errors,
+            })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RaftServer micro-benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    read_path = sub.add_parser("read-path", help="leader get_data latency vs log length")
+    read_path.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6, 3 * 10**6])
+    read_path.add_argument("--reads", type=int, default=2000)
+
+    log_memory = sub.add_parser("log-memory", help="bytes per log entry: entry dicts vs RaftLog vs a whole server")
+    log_memory.add_argument("--entries", type=int, default=10**6)
+    log_memory.add_argument("--value-size", type=int, default=32)
+    log_memory.add_argument("--output", help="append the result as a JSON line to this file")
+
+    wal = sub.add_parser("wal", help="WAL write throughput and recovery time per sync mode")
+    wal.add_argument("--modes", nargs="+", default=["always", "interval", "none"])
+    wal.add_argument("--writers", type=int, default=32)
+    wal.add_argument("--writes", type=int, default=2000)
+    wal.add_argument("--value-size", type=int, default=100)
+
+    wire = sub.add_parser("wire", help="JSON vs binary AppendEntries encoding")
+    wire.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 10000])
+    wire.add_argument("--value-size", type=int, default=32)
+
+    runtime = sub.add_parser("runtime", help="threaded vs async server: throughput and p99 under concurrency")
+    runtime.add_argument("--runtimes", nargs="+", default=["threaded", "async"])
+    runtime.add_argument("--clients", type=int, nargs="+", default=[8, 64, 256])
+    runtime.add_argument("--requests", type=int, default=200)
+    runtime.add_argument("--port", type=int, default=5099)
+
+    shards = sub.add_parser("shards", help="write throughput of a local 5-node cluster vs number of Raft groups")
+    shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    shards.add_argument("--writers", type=int, default=32)
+    shards.add_argument("--duration", type=float, default=10)
+    shards.add_argument("--base-port", type=int, default=6100)
+
+    load = sub.add_parser("load", help="open-loop put/get/patch/delete mix against a local cluster")
+    load.add_argument("--nodes", type=int, default=5)
+    load.add_argument("--mix", default="put=30,get=60,patch=5,delete=5")
+    load.add_argument("--rate", type=float, default=200, help="ops started per second")
+    load.add_argument("--duration", type=float, default=30)
+    load.add_argument("--keys", type=int, default=1000)
+    load.add_argument("--workers", type=int, default=64)
+    load.add_argument("--base-port", type=int, default=6200)
+    load.add_argument("--output", help="append the result as a JSON line to this file")
+
+    failover = sub.add_parser("failover", help="time to a new leader and a committed write after /turnoff of the leader")
+    failover.add_argument("--nodes", type=int, default=5)
+    failover.add_argument("--rounds", type=int, default=5)
+    failover.add_argument("--base-port", type=int, default=6300)
+    failover.add_argument("--election-timeout-min-ms", type=int)
+    failover.add_argument("--election-timeout-max-ms", type=int)
+    failover.add_argument("--heartbeat-interval-ms", type=int)
+    failover.add_argument("--output", help="append the result as a JSON line to this file")
+
+    cas = sub.add_parser("cas", help="contended compare-and-set on hot keys, by old value vs by revision")
+    cas.add_argument("--modes", nargs="+", default=["value", "revision"])
+    cas.add_argument("--workers", type=int, default=32)
+    cas.add_argument("--keys", type=int, default=4)
+    cas.add_argument("--value-size", type=int, default=100000)
+    cas.add_argument("--duration", type=float, default=10)
+    cas.add_argument("--base-port", type=int, default=6400)
+    cas.add_argument("--output", help="append the result as a JSON line to this file")
+
+    sim_failover = sub.add_parser("sim-failover", help="failover time and term churn over seeded simulator runs")
+    sim_failover.add_argument("--nodes", type=int, default=5)
+    sim_failover.add_argument("--runs", type=int, default=200)
+    sim_failover.add_argument("--output", help="append the result as a JSON line to this file")
+
+    args = parser.parse_args()
+    if args.bench == "read-path":
+        bench_read_path(args.sizes, args.reads)
+    elif args.bench == "log-memory":
+        bench_log_memory(args.entries, args.value_size, args.output)
+    elif args.bench == "wal":
+        bench_wal(args.modes, args.writers, args.writes, args.value_size)
+    elif args.bench == "wire":
+        bench_wire(args.sizes, args.value_size)
+    elif args.bench == "runtime":
+        bench_runtime(args.runtimes, args.clients, args.requests, args.port)
+    elif args.bench == "shards":
+        bench_shards(args.shards, args.writers, args.duration, args.base_port)
+    elif args.bench == "load":
+        bench_load(args.nodes, args.mix, args.rate, args.duration, args.keys, args.workers, args.base_port, args.output)
+    elif args.bench == "failover":
+        timers = {
+            "ELECTION_TIMEOUT_MIN_MS": args.election_timeout_min_ms,
+            "ELECTION_TIMEOUT_MAX_MS": args.election_timeout_max_ms,
+            "HEARTBEAT_INTERVAL_MS": args.heartbeat_interval_ms,
+        }
+        bench_failover(
+            args.nodes, args.rounds, args.base_port, args.output,
+            {name: value for name, value in timers.items() if value is not None}
+        )
+    elif args.bench == "cas":
+        bench_cas(args.modes, args.workers, args.keys, args.value_size, args.duration, args.base_port, args.output)
+    elif args.bench == "sim-failover":
+        bench_sim_failover(args.nodes, args.runs, args.output)
+
+
+if __name__ == "__main__":
+    main()
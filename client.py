@@ -0,0 +1,386 @@
+import heapq
+import itertools
+import json
+import threading
+import time
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+# how long a cached /status view is trusted before reads refresh it
+STATUS_TTL = 1.0
+# how long an operation keeps retrying through elections and failovers
+RETRY_TIMEOUT = 15
+REQUEST_TIMEOUT = (0.5, 5)
+
+# leader replies that retrying will not change
+FINAL_ERRORS = {
+    "Key not found", "Value has been changed", "Revision has changed", "Transaction aborted",
+    "A leadership transfer is already running",
+}
+# replies from a server that did not append the write
+NOT_APPLIED_ERRORS = {"Not the leader"}
+
+
+def shard_for(key, shards):
+    """Shard owning key; servers and clients must agree on this."""
+    return zlib.crc32(json.dumps(key).encode()) % shards
+
+
+class RaftClientError(Exception):
+
+    def __init__(self, message, reply=None):
+        super().__init__(message)
+        # the server's full reply, e.g. per-op results of an aborted batch
+        self.reply = reply
+
+
+class AmbiguousWriteError(RaftClientError):
+    """The write reached the leader but its outcome is unknown: it may
+    still commit, so sending it again could apply it twice."""
+
+
+def never_sent(error):
+    """Whether a request failed before any server could have read it."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RaftClient:
+    """Routes requests to the cluster without the try-server-follow-302 dance.
+
+    The leader and the applied version of every replica are learned from
+    /status and cached. Writes go straight to the leader; reads are spread
+    over replicas that have applied everything this client has written.
+    """
+
+    def __init__(self, addresses, pool_size=8, retry_timeout=RETRY_TIMEOUT):
+        self.addresses = dict(addresses)
+        self.retry_timeout = retry_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.addresses), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        self.leader_id = None
+        self.versions = {server_id: 0 for server_id in self.addresses}
+        self.refreshed_at = 0
+        # highest log index written through this client, reads must see it
+        self.read_floor = 0
+        self.turn = itertools.count()
+
+
+    def request(self, method, server_id, path, payload=None):
+        return self.session.request(
+            method,
+            f"{self.addresses[server_id]}{path}",
+            json=payload,
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False
+        )
+
+
+    def refresh(self):
+        """Find the leader via /status and take the replicas' versions from it."""
+        candidates = list(self.addresses)
+        if self.leader_id is not None:
+            candidates.insert(0, self.leader_id)
+        seen = set()
+        while candidates:
+            server_id = candidates.pop(0)
+            if server_id in seen or server_id not in self.addresses:
+                continue
+            seen.add(server_id)
+            try:
+                status = self.request("GET", server_id, "/status").json()
+            except (requests.RequestException, ValueError):
+                continue
+            if not status.get("alive", True):
+                continue
+            if status.get("state") != "leader":
+                # followers usually know who the leader is, ask it next
+                if status.get("leader_id") is not None:
+                    candidates.insert(0, status["leader_id"])
+                continue
+
+            with self.lock:
+                self.leader_id = server_id
+                for peer_id, version in status.get("versions", {}).items():
+                    if int(peer_id) in self.versions:
+                        self.versions[int(peer_id)] = version
+                self.refreshed_at = time.monotonic()
+            return server_id
+
+        with self.lock:
+            self.leader_id = None
+        return None
+
+
+    def invalidate(self, server_id=None):
+        with self.lock:
+            if server_id is not None:
+                self.versions[server_id] = -1
+            if server_id is None or server_id == self.leader_id:
+                self.leader_id = None
+            self.refreshed_at = 0
+
+
+    def pick_replica(self):
+        if time.monotonic() - self.refreshed_at > STATUS_TTL:
+            self.refresh()
+        with self.lock:
+            ready = [
+                server_id for server_id, version in self.versions.items()
+                if version >= self.read_floor and version >= 0
+            ]
+            # the leader redirects reads anyway, keep it for writes
+            followers = [server_id for server_id in ready if server_id != self.leader_id]
+            candidates = followers or ready or [self.leader_id]
+        if candidates == [None]:
+            return None
+        return candidates[next(self.turn) % len(candidates)]
+
+
+    def attempts(self):
+        """Yield until retry_timeout runs out, backing off between tries."""
+        deadline = time.monotonic() + self.retry_timeout
+        for attempt in itertools.count():
+            yield attempt
+            if time.monotonic() >= deadline:
+                raise RaftClientError("Cluster did not answer in time")
+            time.sleep(min(1.0, 0.05 * 2 ** attempt))
+
+
+    def read(self, path, payload, lines=False):
+        """One JSON reply, or with lines=True the objects of an NDJSON reply."""
+        for _ in self.attempts():
+            server_id = self.pick_replica()
+            if server_id is None:
+                continue
+            try:
+                response = self.request("GET", server_id, path, payload)
+                if response.status_code == 302:
+                    # the leader points at a replica that has the key
+                    self.refreshed_at = 0
+                    server_id = response.json()["id"]
+                    response = self.request("GET", server_id, path, payload)
+                if lines:
+                    data = [json.loads(line) for line in response.iter_lines() if line]
+                else:
+                    data = response.json()
+            except (requests.RequestException, ValueError, KeyError):
+                self.invalidate(server_id)
+                continue
+            if (data[-1] if lines else data).get("status") == "error":
+                self.invalidate(server_id)
+                continue
+            return data
+
+
+    def write(self, method, path, payload, idempotent=False):
+        """Send a write to the leader, retrying while it provably was not
+        applied: the connection failed, the server redirected or answered
+        that it is not the leader. A timeout or a commit that did not make
+        it in time is ambiguous, the entry may still commit; idempotent
+        writes are sent again, others raise AmbiguousWriteError."""
+        for _ in self.attempts():
+            leader_id = self.leader_id or self.refresh()
+            if leader_id is None:
+                continue
+            try:
+                response = self.request(method, leader_id, path, payload)
+                data = None if response.status_code == 302 else response.json()
+            except (requests.RequestException, ValueError) as e:
+                self.invalidate(leader_id)
+                if idempotent or isinstance(e, requests.RequestException) and never_sent(e):
+                    continue
+                raise AmbiguousWriteError(f"No answer from server {leader_id}: {e}") from e
+            if data is None:
+                self.invalidate()
+                continue
+            if data.get("status") == "ok":
+                with self.lock:
+                    self.read_floor = max(self.read_floor, data.get("index", 0))
+                return data
+            if data.get("message") in FINAL_ERRORS:
+                raise RaftClientError(data["message"], data)
+            self.invalidate()
+            if not idempotent and data.get("message") not in NOT_APPLIED_ERRORS:
+                raise AmbiguousWriteError(data.get("message", "Write failed"), data)
+
+
+    def get(self, key):
+        return self.read("/get_data", {"key": key}).get("value")
+
+
+    def get_revision(self, key):
+        """(value, revision) of key; revision is None if it does not exist."""
+        data = self.read("/get_data", {"key": key})
+        return data.get("value"), data.get("revision")
+
+
+    def scan(self, prefix="", start=None, end=None, page_size=1000):
+        """Yield (key, value) for string keys in order, a page at a time."""
+        params = {"prefix": prefix, "limit": page_size}
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        while True:
+            *items, trailer = self.read("/scan", params, lines=True)
+            for item in items:
+                yield item["key"], item["value"]
+            if trailer.get("cursor") is None:
+                return
+            params["cursor"] = trailer["cursor"]
+
+
+    def watch(self, key=None, prefix=None, from_index=None):
+        """Yield committed writes to key or prefix, as dicts with index,
+        position, type, key and value. Reconnects to any replica and resumes
+        after the last event, also when the server cut a too slow stream."""
+        params = {"key": key} if key is not None else {"prefix": prefix}
+        if from_index is not None:
+            params["from_index"] = from_index
+        # (index, position) of the last event yielded
+        last = None
+        failures = 0
+        while True:
+            server_id = self.pick_replica()
+            if last is not None:
+                # a batch entry may have been cut off half way, read it again
+                params["from_index"] = last[0]
+            try:
+                if server_id is None:
+                    raise requests.ConnectionError("No server to watch from")
+                with self.session.get(
+                    f"{self.addresses[server_id]}/watch",
+                    params=params,
+                    stream=True,
+                    timeout=REQUEST_TIMEOUT
+                ) as response:
+                    if response.status_code != 200:
+                        reply = response.json()
+                        if response.status_code in (400, 410):
+                            raise RaftClientError(reply["message"], reply)
+                        raise requests.RequestException(reply["message"])
+                    name, data = None, None
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if line.startswith("event: "):
+                            name = line[len("event: "):]
+                        elif line.startswith("data: "):
+                            data = json.loads(line[len("data: "):])
+                        elif not line and data is not None:
+                            if name == "compacted":
+                                raise RaftClientError("Log compacted", data)
+                            seen = (data["index"], data.get("position", 0))
+                            if name != "overflow" and (last is None or seen > last):
+                                last = seen
+                                failures = 0
+                                yield data
+                            name, data = None, None
+            except (requests.RequestException, ValueError):
+                self.invalidate(server_id)
+                time.sleep(min(1.0, 0.05 * 2 ** failures))
+                failures += 1
+
+
+    def put(self, key, value, ttl=None):
+        return self.write("PUT", "/put_data", {"key": key, "value": value, "ttl": ttl}, idempotent=True)
+
+
+    def post(self, key, value, ttl=None):
+        return self.write("POST", "/post_data", {"key": key, "value": value, "ttl": ttl})
+
+
+    def update(self, key, value, old=None, if_revision=None):
+        """Compare-and-set on the old value, or on the key's revision when
+        if_revision is given."""
+        payload = {"key": key, "value": value}
+        if if_revision is None or old is not None:
+            payload["old"] = old
+        if if_revision is not None:
+            payload["if_revision"] = if_revision
+        return self.write("PATCH", "/update_data", payload)
+
+
+    def delete(self, key):
+        return self.write("DELETE", "/delete_data", {"key": key})
+
+
+    def batch(self, ops):
+        """Apply put/delete/update ops atomically, e.g.
+        [{"op": "put", "key": "a", "value": 1, "ttl": 60}, {"op": "update", "key": "b", "value": 2, "if_revision": 7}].
+        Any op may carry if_revision; 0 means the key must not exist.
+        Returns per-op results; raises RaftClientError if any op fails."""
+        return self.write("POST", "/batch", {"ops": ops})["results"]
+
+
+    def transfer_leadership(self, server_id=None):
+        """Move leadership to server_id, or to the most caught up follower."""
+        payload = {"server_id": server_id} if server_id is not None else {}
+        data = self.write("POST", "/transfer_leadership", payload)
+        self.invalidate()
+        return data["leader_id"]
+
+
+class ShardedClient:
+    """A RaftClient per shard of a cluster started with SHARDS > 1.
+
+    Keys go to the Raft group owning them, so each shard's writes go
+    straight to that shard's leader.
+    """
+
+    def __init__(self, addresses, shards, **kwargs):
+        self.clients = [
+            RaftClient({server_id: f"{url}/shard/{shard}" for server_id, url in addresses.items()}, **kwargs)
+            for shard in range(shards)
+        ]
+
+
+    def client(self, key):
+        return self.clients[shard_for(key, len(self.clients))]
+
+
+    def get(self, key):
+        return self.client(key).get(key)
+
+
+    def put(self, key, value, ttl=None):
+        return self.client(key).put(key, value, ttl)
+
+
+    def post(self, key, value, ttl=None):
+        return self.client(key).post(key, value, ttl)
+
+
+    def get_revision(self, key):
+        return self.client(key).get_revision(key)
+
+
+    def update(self, key, value, old=None, if_revision=None):
+        return self.client(key).update(key, value, old, if_revision)
+
+
+    def delete(self, key):
+        return self.client(key).delete(key)
+
+
+    def scan(self, prefix="", start=None, end=None, page_size=1000):
+        return heapq.merge(
+            *(client.scan(prefix, start, end, page_size) for client in self.clients),
+            key=lambda item: item[0]
+        )
+
+
+    def batch(self, ops):
+        """Atomic only within a shard, so all keys must map to one."""
+        shards = {shard_for(op["key"], len(self.clients)) for op in ops}
+        if len(shards) != 1:
+            raise RaftClientError("A batch must stay within one shard")
+        return self.clients[shards.pop()].batch(ops)
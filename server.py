@@ -9,20 +9,144 @@ import sys
 import os
 import socketserver
 import logging
-from flask import Flask, jsonify, request
+import io
+import json
+import struct
+import zlib
+import bisect
+import heapq
+import queue
+from flask import Flask, Response, jsonify, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, islice
+from array import array
 import socket
 import subprocess
-
-
-ELECTION_TIMEOUT_MIN = 4
-ELECTION_TIMEOUT_MAX = 10
-HEARTBEAT_INTERVAL = 1
+import asyncio
+from urllib.parse import urlparse
+from client import shard_for
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+# each election timeout is drawn at random from this range, in milliseconds,
+# so that two candidates rarely time out together
+ELECTION_TIMEOUT_MIN = int(os.getenv("ELECTION_TIMEOUT_MIN_MS", 1500)) / 1000
+ELECTION_TIMEOUT_MAX = int(os.getenv("ELECTION_TIMEOUT_MAX_MS", 3000)) / 1000
+# must stay well below ELECTION_TIMEOUT_MIN
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL_MS", 250)) / 1000
+# how long a leadership transfer may hold writes back before it gives up
+TRANSFER_TIMEOUT = ELECTION_TIMEOUT_MIN
+# servers the balancer moves leadership to, e.g. "1,2": Raft group g prefers
+# the (g mod n)-th one. Empty turns the balancer off
+PREFERRED_LEADERS = [int(server_id) for server_id in os.getenv("PREFERRED_LEADERS", "").split(",") if server_id]
+# seconds between the balancer's checks
+BALANCE_INTERVAL = float(os.getenv("BALANCE_INTERVAL", 10))
+
+# max entries shipped in one AppendEntries message
+REPLICATION_BATCH_SIZE = 512
+# AppendEntries messages allowed in flight per follower
+REPLICATION_PIPELINE_DEPTH = 4
+# how long a client write waits for its entry to commit
+COMMIT_TIMEOUT = 3
+# threads shared by heartbeat and vote fan-outs to followers
+FANOUT_POOL_SIZE = 16
+
+# how followers answer get_data/head_data:
+# read_index: ask the leader for its commit index, wait to apply it, read locally
+# lease: same, but the leader skips the quorum round while it holds a lease
+# forward: proxy the read to the leader
+READ_MODE = os.getenv("READ_MODE", "read_index")
+# must stay below ELECTION_TIMEOUT_MIN: followers refuse votes for that long
+# after hearing from a leader, so no other leader can exist during a lease
+LEASE_DURATION = float(os.getenv("LEASE_DURATION", ELECTION_TIMEOUT_MIN / 2))
+# how long a read waits for the local state machine to catch up
+READ_TIMEOUT = 2
+# what a leader does when it cannot confirm a read (e.g. it was cut off):
+# error: refuse it, stale: answer from local state and mark the reply
+# "stale", giving up linearizability. Followers that cannot get a read
+# index forward the read to the leader.
+READ_FALLBACK = os.getenv("READ_FALLBACK", "error")
+
+# threaded: Werkzeug server with a thread per request
+# async: aiohttp event loop, timers as coroutines, views on a bounded pool
+RUNTIME = os.getenv("RUNTIME", "threaded")
+# threads that run route handlers in the async runtime
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", 64))
+
+# keys returned by one /scan request, and read per pass over the index
+SCAN_MAX_LIMIT = int(os.getenv("SCAN_MAX_LIMIT", 10000))
+SCAN_CHUNK = 256
+
+# events buffered per /watch stream before it is cut off as too slow
+WATCH_BUFFER = int(os.getenv("WATCH_BUFFER", 1024))
+# open /watch streams per Raft group
+WATCH_MAX = int(os.getenv("WATCH_MAX", 256))
+# idle streams get a comment line this often, which also finds dead clients
+WATCH_KEEPALIVE = float(os.getenv("WATCH_KEEPALIVE", 2))
+
+# operations accepted by one /batch request
+BATCH_MAX_OPS = int(os.getenv("BATCH_MAX_OPS", 50000))
+# batch entries latest_write keeps decoded, so checking a batch decodes the
+# entries its keys were last written in once rather than once per key
+DECODED_ENTRIES = 4
+
+# seconds per timer wheel slot: keys with a ttl expire at most this late
+TTL_RESOLUTION = float(os.getenv("TTL_RESOLUTION", 0.1))
+# expired keys deleted by one replicated expire entry
+TTL_EXPIRE_BATCH = int(os.getenv("TTL_EXPIRE_BATCH", 1000))
+
+# keep-alive connections kept per peer
+PEER_POOL_SIZE = int(os.getenv("PEER_POOL_SIZE", 8))
+PEER_CONNECT_TIMEOUT = float(os.getenv("PEER_CONNECT_TIMEOUT", 0.5))
+PEER_READ_TIMEOUT = float(os.getenv("PEER_READ_TIMEOUT", 1))
+# retried only when the connection could not be established, so
+# non-idempotent forwards are never sent twice
+PEER_RETRIES = int(os.getenv("PEER_RETRIES", 1))
+# forwarded writes wait on the leader's commit
+FORWARD_TIMEOUT = (PEER_CONNECT_TIMEOUT, COMMIT_TIMEOUT + PEER_READ_TIMEOUT)
+
+# directory for the write-ahead log, empty string keeps everything in memory
+WAL_DIR = os.getenv("WAL_DIR", "data")
+# always: every write waits for an fsync shared with concurrent writers,
+# interval: fsync every WAL_SYNC_INTERVAL_MS, none: never fsync
+WAL_SYNC = os.getenv("WAL_SYNC", "always")
+WAL_SYNC_INTERVAL_MS = int(os.getenv("WAL_SYNC_INTERVAL_MS", 10))
+
+# applied entries between two snapshots
+SNAPSHOT_THRESHOLD = int(os.getenv("SNAPSHOT_THRESHOLD", 10000))
+# entries kept in memory behind a snapshot for followers that are only a bit behind
+SNAPSHOT_TRAILING_ENTRIES = int(os.getenv("SNAPSHOT_TRAILING_ENTRIES", 1000))
+# bytes per InstallSnapshot request
+SNAPSHOT_CHUNK_SIZE = int(os.getenv("SNAPSHOT_CHUNK_SIZE", 1 << 20))
+
+# frame: switch to the binary AppendEntries encoding with peers that
+# advertise it, json: always send JSON
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "frame")
+FRAME_CONTENT_TYPE = "application/x-raft-frame"
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text: "time - level - message key=value ...", json: one object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# seconds between two summary lines of a server's state
+STATS_LOG_INTERVAL = float(os.getenv("STATS_LOG_INTERVAL", 60))
+# log entries or keys per /debug page, which is only served at LOG_LEVEL=DEBUG
+DEBUG_PAGE_MAX = int(os.getenv("DEBUG_PAGE_MAX", 1000))
 
 SERVER_ID = int(
     os.getenv("SERVER_ID", 1)
 )
 
+# independent Raft groups the keyspace is split into, each with its own
+# log, term and leader; 1 keeps the single unprefixed group
+SHARDS = int(os.getenv("SHARDS", 1))
+
 SERVER_ADDRESSES = {
     1: "http://raft-server-1:5001",
     2: "http://raft-server-2:5002",
@@ -30,57 +154,1092 @@ SERVER_ADDRESSES = {
     4: "http://raft-server-4:5004",
     5: "http://raft-server-5:5005",
 }
+# e.g. "1=http://127.0.0.1:6001,2=http://127.0.0.1:6002,3=http://127.0.0.1:6003"
+# for a cluster of local processes
+if os.getenv("SERVER_ADDRESSES"):
+    SERVER_ADDRESSES = {
+        int(server_id): url
+        for server_id, url in (pair.split("=", 1) for pair in os.getenv("SERVER_ADDRESSES").split(","))
+    }
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record with the fields passed as extra={"fields": ...}:
+    key=value pairs after the message, or a JSON object with json=True."""
+
+    def __init__(self, json_output=False):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+        self.json_output = json_output
+
+
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        if self.json_output:
+            return json.dumps(
+                {
+                    "time": record.created,
+                    "level": record.levelname,
+                    "message": record.getMessage(),
+                    **fields
+                },
+                default=str
+            )
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        return line
 
 
 def setup_logging():
     logger = logging.getLogger("RaftServer")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
     handler = logging.StreamHandler(sys.stderr)
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    handler.setFormatter(StructuredFormatter(json_output=LOG_FORMAT == "json"))
     logger.addHandler(handler)
     return logger
 
 logger = setup_logging()
 
+
+class FrameCodec:
+    """Length-prefixed binary encoding of AppendEntries messages.
+
+    A fixed header is followed by one column per entry field (terms, types,
+    flags, key and value lengths) and two UTF-8 blobs with all keys and all
+    values back to back. Lengths count characters, so each blob is decoded
+    once and sliced instead of parsing every entry separately. Blobs pass
+    lone surrogates through, since JSON lets clients send them.
+    """
+
+    HEADER = struct.Struct("<qqqqqIII")
+    TYPES = {"put": 1, "delete": 2, "noop": 3}
+    NAMES = {code: name for name, code in TYPES.items()}
+    FIELDS = {"type", "key", "value", "term"}
+
+    # flags
+    KEY_JSON = 1
+    VALUE_JSON = 2
+    NO_VALUE = 4
+    # entry that does not fit the columns, carried as JSON in the value blob
+    RAW_ENTRY = 8
+
+
+    @classmethod
+    def encode(cls, message):
+        entries = message["entries"]
+        terms = array("q")
+        types = bytearray()
+        flags = bytearray()
+        keys = []
+        values = []
+        for el in entries:
+            flag = 0
+            if el.get("type") not in cls.TYPES or not cls.FIELDS.issuperset(el):
+                key, value, flag = "", json.dumps(el), cls.RAW_ENTRY | cls.VALUE_JSON
+            else:
+                key = el["key"]
+                if not isinstance(key, str):
+                    key, flag = json.dumps(key), flag | cls.KEY_JSON
+                if "value" not in el:
+                    value, flag = "", flag | cls.NO_VALUE
+                else:
+                    value = el["value"]
+                    if not isinstance(value, str):
+                        value, flag = json.dumps(value), flag | cls.VALUE_JSON
+            terms.append(el.get("term", 0))
+            types.append(cls.TYPES.get(el.get("type"), 0))
+            flags.append(flag)
+            keys.append(key)
+            values.append(value)
+
+        key_blob = "".join(keys).encode(errors="surrogatepass")
+        value_blob = "".join(values).encode(errors="surrogatepass")
+        return b"".join([
+            cls.HEADER.pack(
+                message["term"],
+                message["leader_id"],
+                message["prev_log_index"],
+                message["prev_log_term"] or 0,
+                message["leader_commit"],
+                len(entries),
+                len(key_blob),
+                len(value_blob),
+            ),
+            terms.tobytes(),
+            bytes(types),
+            bytes(flags),
+            array("I", map(len, keys)).tobytes(),
+            array("I", map(len, values)).tobytes(),
+            key_blob,
+            value_blob,
+        ])
+
+
+    @classmethod
+    def decode(cls, data):
+        (term, leader_id, prev_log_index, prev_log_term, leader_commit,
+         count, key_size, value_size) = cls.HEADER.unpack_from(data, 0)
+        offset = cls.HEADER.size
+
+        terms = array("q")
+        terms.frombytes(data[offset:offset + 8 * count])
+        offset += 8 * count
+        types = data[offset:offset + count]
+        offset += count
+        flags = data[offset:offset + count]
+        offset += count
+        key_lengths = array("I")
+        key_lengths.frombytes(data[offset:offset + 4 * count])
+        offset += 4 * count
+        value_lengths = array("I")
+        value_lengths.frombytes(data[offset:offset + 4 * count])
+        offset += 4 * count
+        keys = data[offset:offset + key_size].decode(errors="surrogatepass")
+        offset += key_size
+        values = data[offset:offset + value_size].decode(errors="surrogatepass")
+
+        rows = zip(types, terms, key_lengths, accumulate(key_lengths), value_lengths, accumulate(value_lengths))
+        if not any(flags):
+            entries = [
+                {"type": cls.NAMES[code], "key": keys[key_end - key_len:key_end],
+                 "value": values[value_end - value_len:value_end], "term": entry_term}
+                for code, entry_term, key_len, key_end, value_len, value_end in rows
+            ]
+        else:
+            entries = []
+            for flag, (code, entry_term, key_len, key_end, value_len, value_end) in zip(flags, rows):
+                key = keys[key_end - key_len:key_end]
+                value = values[value_end - value_len:value_end]
+                if flag & cls.RAW_ENTRY:
+                    entries.append(json.loads(value))
+                    continue
+                el = {"type": cls.NAMES[code], "key": json.loads(key) if flag & cls.KEY_JSON else key}
+                if not flag & cls.NO_VALUE:
+                    el["value"] = json.loads(value) if flag & cls.VALUE_JSON else value
+                el["term"] = entry_term
+                entries.append(el)
+
+        return {
+            "leader_id": leader_id,
+            "term": term,
+            "prev_log_index": prev_log_index,
+            "prev_log_term": prev_log_term,
+            "entries": entries,
+            "leader_commit": leader_commit,
+        }
+
+
+class SortedKeys:
+    """Sorted set of string keys for range and prefix scans.
+
+    Keys live in buckets of about LOAD keys with the last key of every
+    bucket in maxes, so an insert shifts one small list rather than the
+    whole index.
+    """
+
+    LOAD = 1000
+
+    def __init__(self, keys=()):
+        keys = sorted(set(keys))
+        self.buckets = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+
+
+    def __len__(self):
+        return sum(map(len, self.buckets))
+
+
+    def add(self, key):
+        if not self.buckets:
+            self.buckets, self.maxes = [[key]], [key]
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j < len(bucket) and bucket[j] == key:
+            return
+        bucket.insert(j, key)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self.maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+
+
+    def discard(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j == len(bucket) or bucket[j] != key:
+            return
+        del bucket[j]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i], self.maxes[i]
+
+
+    def page(self, start, inclusive, count):
+        """Up to count keys from start on, start itself only if inclusive."""
+        find = bisect.bisect_left if inclusive else bisect.bisect_right
+        i = find(self.maxes, start)
+        keys = []
+        if i < len(self.buckets):
+            j = find(self.buckets[i], start)
+            keys = self.buckets[i][j:j + count]
+            i += 1
+        while len(keys) < count and i < len(self.buckets):
+            keys += self.buckets[i][:count - len(keys)]
+            i += 1
+        return keys
+
+
+class TimerWheel:
+    """Keys bucketed by the slot their ttl ends in. Scheduling is O(1) and
+    advancing only visits the slots that elapsed. A key that is written
+    again keeps its old slot; callers check due keys against its current
+    expiry."""
+
+    def __init__(self, resolution=TTL_RESOLUTION):
+        self.resolution = resolution
+        self.slots = defaultdict(list)
+        # first slot not advanced past yet
+        self.current = None
+
+
+    def schedule(self, key, expires_at):
+        slot = int(expires_at / self.resolution)
+        if self.current is not None and slot < self.current:
+            slot = self.current
+        self.slots[slot].append(key)
+
+
+    def advance(self, now):
+        """Take the keys of every slot that ended by now."""
+        slot = int(now / self.resolution)
+        if self.current is None:
+            # a key scheduled far ahead must not move the cursor past now
+            self.current = min(min(self.slots, default=slot), slot)
+        due = []
+        if slot - self.current > len(self.slots):
+            # after a long pause it is cheaper to look at the occupied slots
+            for elapsed in [elapsed for elapsed in self.slots if elapsed <= slot]:
+                due += self.slots.pop(elapsed)
+        else:
+            for elapsed in range(self.current, slot + 1):
+                due += self.slots.pop(elapsed, [])
+        self.current = max(self.current, slot + 1)
+        return due
+
+
+class RaftLog:
+    """Log entries with a compacted prefix.
+
+    Positions are absolute, so self.log[i - 1] is entry i no matter how many
+    entries before it were folded into a snapshot, and len() is the index of
+    the last entry.
+
+    Entries are kept as compact JSON in one bytearray, each followed by a
+    comma, with their start offsets and terms in arrays, and decoded on
+    access: a dict per entry costs several times its encoded size. A run of
+    entries is one JSON array away, so slices decode in a single call.
+    """
+
+    def __init__(self):
+        self.arena = bytearray()
+        # arena position of every entry past the offset, counted from the
+        # start of the log so compaction only drops a prefix
+        self.starts = array("Q")
+        self.entry_terms = array("q")
+        # log position of arena[0]
+        self.base = 0
+        # index and term of the last compacted entry
+        self.offset = 0
+        self.offset_term = 0
+        # first index of every run of same-term entries past the offset,
+        # and its term: conflict hints walk the log a term at a time
+        self.term_starts = []
+        self.terms = []
+
+
+    def __len__(self):
+        return self.offset + len(self.starts)
+
+
+    def __iter__(self):
+        return (self.decode(i) for i in range(len(self.starts)))
+
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+    def end(self, i):
+        return self.starts[i + 1] - self.base if i + 1 < len(self.starts) else len(self.arena)
+
+
+    def decode(self, i):
+        return json.loads(self.arena[self.starts[i] - self.base:self.end(i) - 1])
+
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(len(self))
+            if step != 1:
+                return [self.decode(i - self.offset) for i in range(start, stop, step) if i >= self.offset]
+            start, stop = max(start - self.offset, 0), max(stop - self.offset, 0)
+            if start >= stop:
+                return []
+            run = self.arena[self.starts[start] - self.base:self.end(stop - 1) - 1]
+            return json.loads(b"[" + run + b"]")
+        if position < self.offset:
+            raise IndexError(f"log entry {position + 1} was compacted")
+        return self.decode(position - self.offset)
+
+
+    def term(self, position):
+        """Term of self[position] without decoding it."""
+        return self.entry_terms[position - self.offset]
+
+
+    def retained(self):
+        """Entries past the offset, the ones held in memory."""
+        return len(self.starts)
+
+
+    def __delitem__(self, position):
+        # only suffixes are ever dropped
+        i = position.start - self.offset
+        if i < len(self.starts):
+            del self.arena[self.starts[i] - self.base:]
+            del self.starts[i:], self.entry_terms[i:]
+        runs = bisect.bisect_right(self.term_starts, len(self))
+        del self.term_starts[runs:], self.terms[runs:]
+
+
+    def append(self, entry):
+        self.starts.append(self.base + len(self.arena))
+        self.arena += json.dumps(entry, separators=(",", ":")).encode()
+        self.arena += b","
+        term = entry.get("term", 0)
+        self.entry_terms.append(term)
+        if not self.terms or self.terms[-1] != term:
+            self.term_starts.append(len(self))
+            self.terms.append(term)
+
+
+    def compact(self, index, term):
+        i = index - self.offset
+        if i < len(self.starts):
+            del self.arena[:self.starts[i] - self.base]
+            self.base = self.starts[i]
+        else:
+            self.base += len(self.arena)
+            self.arena = bytearray()
+        del self.starts[:i], self.entry_terms[:i]
+        self.offset = index
+        self.offset_term = term
+        # the run holding entry index + 1 now starts there
+        runs = max(0, bisect.bisect_right(self.term_starts, index + 1) - 1)
+        del self.term_starts[:runs], self.terms[:runs]
+        if not self.starts:
+            self.term_starts, self.terms = [], []
+        elif self.term_starts[0] <= index:
+            self.term_starts[0] = index + 1
+
+
+    def reset(self, index, term):
+        self.arena = bytearray()
+        self.starts = array("Q")
+        self.entry_terms = array("q")
+        self.base = 0
+        self.offset = index
+        self.offset_term = term
+        self.term_starts, self.terms = [], []
+
+
+    def term_start(self, index):
+        """First index of the run of same-term entries holding index."""
+        run = bisect.bisect_right(self.term_starts, index) - 1
+        return self.term_starts[run] if run >= 0 else self.offset + 1
+
+
+    def last_index_of(self, term):
+        """Last index holding term, or None if no entry past the offset has it."""
+        run = bisect.bisect_right(self.terms, term) - 1
+        if run < 0 or self.terms[run] != term:
+            return None
+        return self.term_starts[run + 1] - 1 if run + 1 < len(self.terms) else len(self)
+
+
+class SnapshotStore:
+    """Latest snapshot bytes, kept next to the WAL or in memory.
+
+    A snapshot sent by the leader is assembled on the side, one transfer at
+    a time. A transfer is named by the leader's (term, last_index) and its
+    chunks must arrive in order; callers serialize receive and finish.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        # the transfer being received and its bytes so far
+        self.transfer = None
+        self.received = 0
+        self.partial = None
+        if path and os.path.isdir(os.path.dirname(path) or "."):
+            # transfers cut short by a restart
+            directory, name = os.path.split(path)
+            for entry in os.listdir(directory or "."):
+                if entry.startswith(name + ".") and entry.endswith(".part"):
+                    os.remove(os.path.join(directory, entry))
+
+
+    def save(self, data):
+        if not self.path:
+            self.data = data
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+    def load(self):
+        if not self.path:
+            return self.data
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+    def open(self):
+        # an open handle keeps reading the old file if a newer snapshot replaces it
+        if not self.path:
+            return io.BytesIO(self.data or b"")
+        return open(self.path, "rb")
+
+
+    def partial_path(self):
+        term, index = self.transfer
+        return f"{self.path}.{term}-{index}.part"
+
+
+    def receive(self, transfer, offset, chunk):
+        """Add chunk at offset to transfer. Offset 0 starts it over and
+        replaces an older transfer in progress; False for a chunk out of
+        order or of a transfer that was replaced."""
+        if offset == 0 and (self.transfer is None or transfer >= self.transfer):
+            self.discard()
+            self.transfer = transfer
+        if transfer != self.transfer or offset != self.received:
+            return False
+        if not self.path:
+            self.partial += chunk
+        else:
+            with open(self.partial_path(), "ab") as f:
+                f.write(chunk)
+        self.received += len(chunk)
+        return True
+
+
+    def finish(self):
+        """Make the received transfer the latest snapshot and return it."""
+        if not self.path:
+            self.data = bytes(self.partial)
+        else:
+            with open(self.partial_path(), "rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(self.partial_path(), self.path)
+        self.transfer, self.received, self.partial = None, 0, None
+        return self.load()
+
+
+    def discard(self):
+        if self.transfer is not None and self.path and os.path.exists(self.partial_path()):
+            os.remove(self.partial_path())
+        self.transfer, self.received = None, 0
+        self.partial = None if self.path else bytearray()
+
+
+class WriteAheadLog:
+    """Append-only file of checksummed records with group commit.
+
+    Each record is a little-endian (length, crc32) header followed by a
+    JSON payload. A torn or corrupt tail is cut off on replay.
+    """
+
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, path, sync_mode=WAL_SYNC, sync_interval=WAL_SYNC_INTERVAL_MS / 1000):
+        self.path = path
+        self.sync_mode = sync_mode
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.written = 0
+        self.flushed = 0
+        self.flushing = False
+        self.fsyncs = 0
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+
+    def replay(self):
+        records = []
+        if not self.path or not os.path.exists(self.path):
+            return records
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, offset)
+            start = offset + self.HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records.append(json.loads(payload))
+            offset = start + length
+
+        if offset < len(data):
+            logger.warning("WAL %s: dropping %d bytes of torn tail", self.path, len(data) - offset)
+            os.truncate(self.path, offset)
+        return records
+
+
+    def open(self):
+        if not self.path:
+            return
+        self.file = open(self.path, "ab")
+        if self.sync_mode != "always":
+            threading.Thread(
+                target=self.run_flusher,
+                daemon=True
+            ).start()
+
+
+    def append(self, record):
+        if self.file is None:
+            return 0
+        payload = json.dumps(record, separators=(",", ":")).encode()
+        with self.lock:
+            self.file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            self.written += 1
+            return self.written
+
+
+    def sync(self):
+        """Wait until everything appended so far is on disk.
+
+        The first waiter flushes and fsyncs for everyone that appended
+        before it started, the rest just wait for it.
+        """
+        if self.file is None or self.sync_mode != "always":
+            return
+        with self.lock:
+            target = self.written
+            while self.flushed < target:
+                if self.flushing:
+                    self.synced.wait()
+                    continue
+                self.flushing = True
+                batch = self.written
+                self.file.flush()
+                self.lock.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.lock.acquire()
+                    self.flushing = False
+                self.fsyncs += 1
+                self.flushed = batch
+                self.synced.notify_all()
+
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.sync_interval)
+            with self.lock:
+                if self.flushed == self.written or self.flushing:
+                    continue
+                self.flushing = True
+                batch = self.written
+                self.file.flush()
+            try:
+                if self.sync_mode == "interval":
+                    os.fsync(self.file.fileno())
+                    self.fsyncs += 1
+            finally:
+                with self.lock:
+                    self.flushing = False
+                    self.flushed = batch
+                    self.synced.notify_all()
+
+
+    def rewrite(self, records):
+        """Atomically replace the file with records() once a snapshot covers the rest."""
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with self.lock:
+            while self.flushing:
+                self.synced.wait()
+            with open(tmp, "wb") as f:
+                for record in records():
+                    payload = json.dumps(record, separators=(",", ":")).encode()
+                    f.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+                    f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            if self.file is not None:
+                self.file.close()
+            os.replace(tmp, self.path)
+            self.file = open(self.path, "ab")
+            self.flushed = self.written
+            self.synced.notify_all()
+
+
+class PeerPool:
+    """One keep-alive requests.Session per peer in SERVER_ADDRESSES."""
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.sessions = dict()
+        for server_id, url in addresses.items():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=PEER_POOL_SIZE,
+                max_retries=Retry(
+                    total=PEER_RETRIES,
+                    connect=PEER_RETRIES,
+                    read=0,
+                    status=0,
+                    redirect=0,
+                    backoff_factor=0.05
+                )
+            )
+            session.mount(url, adapter)
+            self.sessions[server_id] = session
+
+
+    def request(self, method, server_id, path, **kwargs):
+        kwargs.setdefault("timeout", (PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT))
+        return self.sessions[server_id].request(
+            method,
+            f"{self.addresses[server_id]}{path}",
+            **kwargs
+        )
+
+
+    def get(self, server_id, path, **kwargs):
+        return self.request("GET", server_id, path, **kwargs)
+
+
+    def post(self, server_id, path, **kwargs):
+        return self.request("POST", server_id, path, **kwargs)
+
+
+    def put(self, server_id, path, **kwargs):
+        return self.request("PUT", server_id, path, **kwargs)
+
+
+    def patch(self, server_id, path, **kwargs):
+        return self.request("PATCH", server_id, path, **kwargs)
+
+
+    def delete(self, server_id, path, **kwargs):
+        return self.request("DELETE", server_id, path, **kwargs)
+
+
+    def head(self, server_id, path, **kwargs):
+        return self.request("HEAD", server_id, path, **kwargs)
+
+
+    def stats(self):
+        stats = dict()
+        for server_id, url in self.addresses.items():
+            pools = self.sessions[server_id].get_adapter(url).poolmanager.pools
+            opened = made = 0
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                made += pool.num_requests
+            stats[server_id] = {
+                "requests": made,
+                "opened": opened,
+                "reused": max(0, made - opened),
+            }
+        return stats
+
+
+class Metrics:
+    """Counters and latency histograms for /metrics, in the Prometheus
+    text format. Recording is a dict update under one lock; the text is
+    only built when scraped."""
+
+    FAMILIES = {
+        "raft_requests_total": ("counter", "Requests answered, by route and HTTP status"),
+        "raft_request_seconds": ("histogram", "Time to answer a request, by route"),
+        "raft_forwarded_requests_total": ("counter", "Client requests forwarded to the leader, by route"),
+        "raft_replication_seconds": ("histogram", "AppendEntries round trip, by follower"),
+        "raft_replication_failures_total": ("counter", "AppendEntries that got no answer, by follower"),
+        "raft_commit_seconds": ("histogram", "Time from proposing a write to applying it on the leader"),
+        "raft_commit_failures_total": ("counter", "Writes the leader could not commit"),
+        "raft_elections_total": ("counter", "Elections this server ran, by result"),
+        "raft_election_seconds": ("histogram", "Time to collect the votes of an election"),
+        "raft_leadership_transfers_total": ("counter", "Leadership transfers this server started, by result"),
+        "raft_snapshot_installs_total": ("counter", "Snapshot chunks and installs from the leader, by result"),
+        "raft_term": ("gauge", "Current term"),
+        "raft_is_leader": ("gauge", "1 on the leader"),
+        "raft_log_entries": ("gauge", "Log length, snapshotted entries included"),
+        "raft_commit_index": ("gauge", "Highest committed log index"),
+        "raft_last_applied": ("gauge", "Highest log index applied to the state machine"),
+        "raft_apply_lag": ("gauge", "Committed entries not applied yet"),
+        "raft_keys": ("gauge", "Keys in the state machine"),
+        "raft_ttl_keys": ("gauge", "Keys with a ttl"),
+        "raft_watchers": ("gauge", "Open /watch streams"),
+        "raft_wal_fsyncs_total": ("counter", "fsyncs of the write-ahead log"),
+    }
+    # upper bounds in seconds, from a local read to a commit that times out
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, **labels):
+        # added to every sample, e.g. the shard
+        self.labels = tuple(labels.items())
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        # per bucket counts, then the +Inf bucket, then the sum
+        self.histograms = dict()
+
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] += amount
+
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(labels.items()))
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += seconds
+
+
+    def samples(self, gauges=None):
+        """(family, sample name, labels, value) for everything recorded,
+        plus gauges read at scrape time."""
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, list(counts)) for key, counts in self.histograms.items()]
+        for name, value in (gauges or {}).items():
+            yield name, name, self.labels, value
+        for (name, labels), value in counters:
+            yield name, name, self.labels + labels, value
+        for (name, labels), counts in histograms:
+            labels = self.labels + labels
+            total = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), counts):
+                total += count
+                yield name, f"{name}_bucket", labels + (("le", str(bound)),), total
+            yield name, f"{name}_sum", labels, counts[-1]
+            yield name, f"{name}_count", labels, total
+
+
+def render_metrics(samples):
+    families = defaultdict(list)
+    for family, name, labels, value in samples:
+        families[family].append((name, labels, value))
+    lines = []
+    for family, (kind, text) in Metrics.FAMILIES.items():
+        if family not in families:
+            continue
+        lines.append(f"# HELP {family} {text}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in families[family]:
+            if labels:
+                name += "{" + ",".join(f"{label}={json.dumps(str(label_value))}" for label, label_value in labels) + "}"
+            lines.append(f"{name} {int(value) if value == int(value) else value}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+class Watcher:
+    """One /watch stream. The apply thread offers it matching events without
+    ever blocking; a watcher that falls WATCH_BUFFER events behind is marked
+    overflowed and its stream ends once the buffer is drained."""
+
+    def __init__(self, key=None, prefix=None):
+        self.key = key
+        self.prefix = prefix
+        self.events = queue.Queue(WATCH_BUFFER)
+        self.overflowed = False
+        # entry of the first event that did not fit
+        self.dropped_from = None
+
+
+    def matches(self, key):
+        if self.key is not None:
+            return key == self.key
+        return isinstance(key, str) and key.startswith(self.prefix)
+
+
+    def offer(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+            self.dropped_from = event["index"]
+
+
+class Replicator:
+    """Ships log entries from the leader to one follower."""
+
+    def __init__(self, raft, server_id):
+        self.raft = raft
+        self.server_id = server_id
+        self.wakeup = threading.Event()
+        self.inflight = threading.Semaphore(REPLICATION_PIPELINE_DEPTH)
+        self.pool = ThreadPoolExecutor(
+            max_workers=REPLICATION_PIPELINE_DEPTH,
+            thread_name_prefix=f"repl-{server_id}"
+        )
+
+
+    def notify(self):
+        self.wakeup.set()
+
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.raft.deadimitation()
+
+            while self.raft.state == "leader":
+                if self.raft.needs_snapshot(self.server_id):
+                    self.send_snapshot()
+                    break
+                self.inflight.acquire()
+                message = self.raft.next_batch(self.server_id)
+                if message is None:
+                    self.inflight.release()
+                    break
+                self.pool.submit(self.send, message)
+
+
+    def send(self, message):
+        started = time.perf_counter()
+        try:
+            response = self.raft.post_append(
+                self.server_id,
+                "/repl",
+                message
+            )
+            self.raft.registry.observe("raft_replication_seconds", time.perf_counter() - started, peer=self.server_id)
+            self.raft.handle_append_response(self.server_id, message, response.json())
+        except Exception as e:
+            if not isinstance(e, requests.exceptions.RequestException):
+                logger.exception("Replicating to server %d failed", self.server_id)
+            self.raft.registry.inc("raft_replication_failures_total", peer=self.server_id)
+            # resend from this batch on the next heartbeat round
+            self.raft.rewind_next_index(self.server_id, message["prev_log_index"] + 1)
+        finally:
+            self.inflight.release()
+
+
+    def send_snapshot(self):
+        raft = self.raft
+        with raft.lock:
+            term = raft.leader_term
+            index, index_term = raft.snapshot_index, raft.snapshot_term
+        logger.info("Sending snapshot at %d to server %d", index, self.server_id)
+
+        offset = 0
+        try:
+            with raft.snapshots.open() as snapshot:
+                size = snapshot.seek(0, io.SEEK_END)
+                snapshot.seek(0)
+                while True:
+                    chunk = snapshot.read(SNAPSHOT_CHUNK_SIZE)
+                    done = offset + len(chunk) >= size
+                    response = raft.peers.post(
+                        self.server_id,
+                        "/install_snapshot",
+                        params={
+                            "leader_id": raft.server_id,
+                            "term": term,
+                            "last_index": index,
+                            "last_term": index_term,
+                            "offset": offset,
+                            "done": int(done),
+                        },
+                        data=chunk,
+                        headers={"Content-Type": "application/octet-stream"}
+                    )
+                    data = response.json()
+                    if data.get("term", 0) > raft.term:
+                        raft.step_down(data["term"])
+                        return
+                    if not data.get("success") or term != raft.term:
+                        return
+                    offset += len(chunk)
+                    if done:
+                        break
+        except requests.exceptions.RequestException:
+            return
+        raft.handle_snapshot_installed(self.server_id, index)
+
+
 class RaftServer:
 
-    def __init__(self, server_id: int):
+    def __init__(self, server_id: int, data_dir=WAL_DIR, shard=None, app=None):
         self.server_id = server_id
+        # a shard's routes and peers live under /shard/<shard>
+        self.shard = shard
+        self.prefix = "" if shard is None else f"/shard/{shard}"
+        self.port = urlparse(SERVER_ADDRESSES[server_id]).port or 5000 + server_id
         self.state = "follower"
         self.leader_id = None
         self.last_heartbeat_time = time.time()
         self.term = 0
+        # the term we were elected in; everything we send or append as
+        # leader carries it, never self.term, which a step down may have
+        # raised under our feet
+        self.leader_term = 0
         self.votes_by_term = dict()
         self.alive = True
+        # set while alive, the threads of a turned off server wait on it
+        self.awake = threading.Event()
+        self.awake.set()
+        # set while leading, wakes the heartbeat thread
+        self.leading = threading.Event()
 
         self.change_log = dict()
-
-        self.buf = []
+        # string keys of change_log in order, for /scan
+        self.ordered_keys = SortedKeys()
+        # open /watch streams, guarded by apply_lock
+        self.watchers = set()
+        # key -> wall clock time its ttl ends, for keys written with one.
+        # Like change_log only the apply thread writes these; reads hide
+        # expired keys until the leader's expire entry deletes them.
+        self.expiry = dict()
+        self.timers = TimerWheel()
+        # expired keys waiting for that entry, guarded by apply_lock
+        self.expiring = set()
+        # the leader keeps one expire entry in flight
+        self.expire_index = 0
 
         self.versions = dict()
 
+        # key -> 1-based position in self.log of the key's last write
+        self.key_index = dict()
+        # key -> position among its entry's writes, for keys last written by
+        # a batch or expire entry still in the log
+        self.write_slots = dict()
+        # log position -> entry_writes of a recently read batch entry
+        self.decoded_entries = dict()
+        # key -> revision of its applied value: the log index that wrote it
+        self.revisions = dict()
+
         self.current_term = 0
         self.voted_for = None
-        self.log = list()
-        self.commit_index = -1
-        self.last_applied = -1
+        # log indexes are 1-based: entry i lives in self.log[i - 1]
+        self.log = RaftLog()
+        # last entry folded into the latest snapshot
+        self.snapshot_index = 0
+        self.snapshot_term = 0
+        self.commit_index = 0
+        self.last_applied = 0
         self.next_index = {}
         self.match_index = {}
+        # last index known to be on this server's disk, the leader's own vote
+        # towards a commit
+        self.durable_index = 0
+
+        # Locking, outermost first; never take an outer lock while holding
+        # an inner one:
+        # apply_lock: held by the apply thread while it writes change_log
+        # and by whatever replaces change_log wholesale (snapshots). Readers
+        # take no lock, change_log has a single writer.
+        # term_lock: term, votes_by_term and the follower/leader switch.
+        # lock: log, commit/apply indexes and next/match_index.
+        # install_lock, outside all of them: one snapshot install at a time.
+        self.install_lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.term_lock = threading.RLock()
+        self.lock = threading.RLock()
+        self.applied = threading.Condition(self.lock)
+        self.committed = threading.Condition(self.lock)
+
+        # ReadIndex: concurrent reads share one leadership-confirming round
+        self.read_rounds = threading.Condition()
+        self.read_round_running = False
+        self.confirmed_at = 0
+        self.lease_expiry = 0
+        self.stats_logged_at = 0
+        # the follower leadership is being handed to; no writes until then
+        self.transfer_target = None
+        self.transfer_deadline = 0
+        self.timeout_now_sent = False
 
         for server_id in SERVER_ADDRESSES:
             self.versions[server_id] = 0
 
-        self.election_timeout = (
-            ELECTION_TIMEOUT_MIN + self.server_id * 3
+        self.registry = Metrics() if shard is None else Metrics(shard=shard)
+
+        self.peers = PeerPool({server_id: url + self.prefix for server_id, url in SERVER_ADDRESSES.items()})
+        # wire format per follower, upgraded once it advertises frame support
+        self.peer_codecs = {server_id: "json" for server_id in SERVER_ADDRESSES}
+        self.replicators = {
+            server_id: Replicator(self, server_id)
+            for server_id in SERVER_ADDRESSES
+            if server_id != self.server_id
+        }
+        self.fanout = ThreadPoolExecutor(
+            max_workers=FANOUT_POOL_SIZE,
+            thread_name_prefix="fanout"
         )
-        self.election_timeout_start_time = time.time()
 
-        self.app = Flask(__name__)
+        name = f"raft-{self.server_id}" if shard is None else f"raft-{self.server_id}-shard{shard}"
+        self.wal = WriteAheadLog(
+            os.path.join(data_dir, f"{name}.wal") if data_dir else None
+        )
+        self.snapshots = SnapshotStore(
+            os.path.join(data_dir, f"{name}.snapshot") if data_dir else None
+        )
+        self.recover()
+        self.wal.open()
+
+        self.rng = random.Random()
+        # the first timeout of each server falls in its own slice of the
+        # range, so each shard's first candidate is a different server,
+        # which spreads the leaders over the cluster
+        rank = (self.server_id - 1 - (shard or 0)) % len(SERVER_ADDRESSES)
+        self.election_deadline = time.time() + ELECTION_TIMEOUT_MIN + (
+            (ELECTION_TIMEOUT_MAX - ELECTION_TIMEOUT_MIN) * (rank + self.rng.random()) / len(SERVER_ADDRESSES)
+        )
+
+        self.app = app or Flask(__name__)
         self.initialize_routes()
     def initialize_routes(self):
-        routes = [
+        self.routes = [
             ("/heartbeat", self.heartbeat, ["POST"]),
             ("/vote", self.vote, ["POST"]),
+            ("/timeout_now", self.timeout_now, ["POST"]),
+            ("/transfer_leadership", self.transfer_leadership, ["POST"]),
             ("/status", self.status, ["GET"]),
             ("/turnoff", self.turnoff, ["GET"]),
             ("/turnon", self.turnon, ["GET"]),
@@ -91,61 +1250,84 @@ class RaftServer:
             ("/head_data", self.head_data, ["HEAD"]),
             ("/update_data", self.update_data, ["PATCH"]),
             ("/repl", self.repl, ["POST"]),
+            ("/install_snapshot", self.install_snapshot, ["POST"]),
+            ("/read_index", self.read_index, ["GET"]),
+            ("/batch", self.batch, ["POST"]),
+            ("/scan", self.scan, ["GET"]),
+            ("/watch", self.watch, ["GET"]),
+            ("/metrics", self.metrics, ["GET"]),
+            ("/debug", self.debug, ["GET"]),
         ]
-        for rule, view_func, methods in routes:
-            self.app.add_url_rule(rule, view_func.__name__, view_func, methods=methods)
+        # by name, for the root routes of a ShardedNode
+        self.views = {view_func.__name__: self.timed(rule, view_func) for rule, view_func, _ in self.routes}
+        self.routes = [
+            (self.prefix + rule, self.views[view_func.__name__], methods)
+            for rule, view_func, methods in self.routes
+        ]
+        for rule, view_func, methods in self.routes:
+            endpoint = view_func.__name__ if self.shard is None else f"shard{self.shard}.{view_func.__name__}"
+            self.app.add_url_rule(rule, endpoint, view_func, methods=methods)
 
 
-    def repl(self):
-        data = request.get_json()
-        leader_id = data.get("leader_id")
-        term = data.get("term")
+    def timed(self, route, view_func):
+        """view_func, counting its requests and timing them per route."""
+        def view():
+            started = time.perf_counter()
+            response = view_func()
+            code = response[1] if isinstance(response, tuple) else response.status_code
+            self.registry.observe("raft_request_seconds", time.perf_counter() - started, route=route)
+            self.registry.inc("raft_requests_total", route=route, code=code)
+            return response
+        view.__name__ = view_func.__name__
+        return view
 
-        if self.term > term:
-            return jsonify({"status": "bad"})
 
-        if self.term <= term:
-            self.state = "follower"
-            self.term = term
+    def metrics(self):
+        return render_metrics(self.metric_samples())
 
-        if leader_id is not None:
-            self.last_heartbeat_time = time.time()
-            self.leader_id = leader_id
-
-        if "change_log" in data:
-            self.buf = self.log.copy()
-            for el in data.get("change_log"):
-                self.buf.append(el)
-            return jsonify({"status": "ack"})
-            
-        if "commit" in data:
-            for el in self.buf:
-                self.log.append(el)
-                if el["type"] == "put":
-                    self.change_log[el["key"]] = el["value"]
-                if el["type"] == "delete":
-                    del self.change_log[el["key"]]
-            
-            return jsonify({"status": "ok"})
-        
-        return jsonify({"status": "bad"})
-        
+
+    def metric_samples(self):
+        return self.registry.samples(
+            {
+                "raft_term": self.term,
+                "raft_is_leader": int(self.state == "leader"),
+                "raft_log_entries": len(self.log),
+                "raft_commit_index": self.commit_index,
+                "raft_last_applied": self.last_applied,
+                "raft_apply_lag": self.commit_index - self.last_applied,
+                "raft_keys": len(self.change_log),
+                "raft_ttl_keys": len(self.expiry),
+                "raft_watchers": len(self.watchers),
+                "raft_wal_fsyncs_total": self.wal.fsyncs,
+            }
+        )
+
+
+    def repl(self):
+        self.deadimitation()
+
+        return jsonify(self.append_entries(self.read_append_request()))
         
 
     def get_data(self):
         data = request.get_json()
         key = data.get("key")
 
-        if self.state != "leader":
+        if self.state != "leader" and READ_MODE != "forward" and self.read_barrier():
+            return self.local_read(key)
+        elif self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/get_data")
             try:
-                response = requests.get(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/get_data",
+                response = self.peers.get(
+                    self.leader_id,
+                    "/get_data",
                     json={"key": key},
-                    timeout=1
+                    allow_redirects=False
                 )
+                # pass the leader's 302 through to the caller
                 return jsonify(
                     response.json()
-                )
+                ), response.status_code
             except requests.RequestException as e:
                 return jsonify(
                     {
@@ -154,37 +1336,27 @@ class RaftServer:
                     }
                 )
         else:
-            key_ver = -1
-            i = 0
-            #might be replaced with Treap to obtain log(n) complexity, or maintain 
-            #in the db along with the data the postion in log journal to get O(1)
-            for el in self.log[::-1]:
-                if key == el["key"]:
-                    key_ver = len(self.log) - i
-                    break
-                i += 1
+            key_ver = self.key_index.get(key, -1)
             for server_id in SERVER_ADDRESSES:
                 if self.versions[server_id] > key_ver:
                     return jsonify({"id" : server_id}), 302
-            return jsonify(
-                {
-                    "key": key, 
-                    "value": self.change_log.get(key)
-                }
-            )
+            return self.local_read(key, stale=not self.read_barrier())
 
 
     def put_data(self):
         data = request.get_json()
         key = data.get("key")
         value = data.get("value")
+        ttl = data.get("ttl")
 
         if self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/put_data")
             try:
-                response = requests.post(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/put_data",
-                    json={"key": key, "value": value},
-                    timeout=1
+                response = self.peers.put(
+                    self.leader_id,
+                    "/put_data",
+                    json={"key": key, "value": value, "ttl": ttl},
+                    timeout=FORWARD_TIMEOUT
                 )
                 return jsonify(response.json())
             except requests.RequestException as e:
@@ -194,23 +1366,31 @@ class RaftServer:
                         "message": str(e)
                     }
                 )
+        elif not valid_ttl(ttl):
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "ttl must be a positive number of seconds"
+                }
+            )
         else:
-            self.log.append({'type' : "put", "key": key, "value": value})
-            self.change_log[key] = value
-            return jsonify({"status": "ok"})
+            return self.replicate_write(self.put_entry(key, value, ttl))
 
 
     def post_data(self):
         data = request.get_json()
         key = data.get("key")
         value = data.get("value")
+        ttl = data.get("ttl")
 
         if self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/post_data")
             try:
-                response = requests.post(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/post_data",
-                    json={"key": key, "value": value},
-                    timeout=1
+                response = self.peers.post(
+                    self.leader_id,
+                    "/post_data",
+                    json={"key": key, "value": value, "ttl": ttl},
+                    timeout=FORWARD_TIMEOUT
                 )
                 return jsonify(
                     response.json()
@@ -222,10 +1402,15 @@ class RaftServer:
                         "message": str(e)
                     }
                 )
+        elif not valid_ttl(ttl):
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "ttl must be a positive number of seconds"
+                }
+            )
         else:
-            self.change_log[key] = value
-            self.log.append({'type' : "put", "key": key, "value": value})
-            return jsonify({"status": "ok"})
+            return self.replicate_write(self.put_entry(key, value, ttl))
 
 
     def delete_data(self):
@@ -233,11 +1418,13 @@ class RaftServer:
         key = data.get("key")
 
         if self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/delete_data")
             try:
-                response = requests.delete(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/delete_data",
+                response = self.peers.delete(
+                    self.leader_id,
+                    "/delete_data",
                     json={"key": key},
-                    timeout=1
+                    timeout=FORWARD_TIMEOUT
                 )
                 return jsonify(response.json())
             except requests.RequestException as e:
@@ -248,10 +1435,13 @@ class RaftServer:
                     }
                 )
         else:
-            if key in self.change_log:
-                self.log.append({'type' : "delete", "key": key})
-                del self.change_log[key]
-                return jsonify({"status": "ok"})
+            with self.lock:
+                if self.latest_value(key) is not None:
+                    index = self.propose({'type' : "delete", "key": key})
+                else:
+                    index = None
+            if index is not None:
+                return self.commit_response(index)
             return jsonify(
                 {
                     "status": "error", 
@@ -264,14 +1454,17 @@ class RaftServer:
         data = request.get_json()
         key = data.get("key")
 
-        if self.state != "leader":
+        if self.state != "leader" and READ_MODE != "forward" and self.read_barrier():
+            return self.local_read(key, head=True)
+        elif self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/head_data")
             try:
-                response = requests.head(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/head_data",
+                response = self.peers.head(
+                    self.leader_id,
+                    "/head_data",
                     json={
                         "key": key
-                    },
-                    timeout=1
+                    }
                 )
                 return jsonify(response.headers)
             except requests.RequestException as e:
@@ -282,17 +1475,7 @@ class RaftServer:
                     }
                 )
         else:
-            if key in self.change_log:
-                return jsonify(
-                    {
-                        "status": "exists"
-                    }
-                )
-            return jsonify(
-                {
-                    "status": "not found"
-                }
-            )
+            return self.local_read(key, head=True, stale=not self.read_barrier())
 
 
     def update_data(self):
@@ -302,14 +1485,13 @@ class RaftServer:
         old = data.get("old")
 
         if self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/update_data")
             try:
-                response = requests.patch(
-                    f"{SERVER_ADDRESSES[self.leader_id]}/update_data",
-                    json={
-                        "key": key, 
-                        "value": value
-                    },
-                    timeout=1
+                response = self.peers.patch(
+                    self.leader_id,
+                    "/update_data",
+                    json=data,
+                    timeout=FORWARD_TIMEOUT
                 )
                 return jsonify(response.json())
             except requests.RequestException as e:
@@ -320,88 +1502,1129 @@ class RaftServer:
                     }
                 )
         else:
-            if key in self.change_log:
-                if self.change_log[key] != old:
+            op = {"op": "update", "key": key, "value": value, "old": old}
+            if data.get("if_revision") is not None:
+                # the revision alone decides, unless old is sent too
+                op["if_revision"] = data["if_revision"]
+                if "old" not in data:
+                    del op["old"]
+            # checked against the newest write in the log, committed or not,
+            # so two CAS calls racing on the leader cannot both succeed; the
+            # losers fail here and never reach the log
+            with self.lock:
+                writes, results = self.check_batch([op])
+                if writes is None:
                     return jsonify(
                         {
-                            "status": "error", 
-                            "message": "Value has been changed"
-                        }
-                    )
-                self.change_log[key] = value
-                self.log.append({'type' : "put", "key": key, "value": value})
-                cnt = 0
-                for server_id, url in SERVER_ADDRESSES.items():
-                    if server_id != self.server_id:
-                        try:
-                            response = requests.post(
-                                f"{url}/heartbeat",
-                                json={
-                                    "leader_id": self.server_id,
-                                    "term": self.term,
-                                },
-                                timeout=1
-                            )
-                            data = response.json()
-                            cur_len = data.get("cur_len")
-                            if cur_len < len(self.log):
-                                if cur_len == 0:
-                                    cur_len += 1
-                                response = requests.post(
-                                f"{url}/repl",
-                                json={
-                                    "leader_id": self.server_id,
-                                    "term": self.term,
-                                    "change_log": list(self.log[cur_len - 1:])
-                                },
-                                timeout=1
-                                )
-                                #self.versions[server_id] = response.json().get("cur_len")
-                                if response.json().get("status") == "ack":
-                                    cnt += 1
-                        except requests.exceptions.RequestException:
-                            pass
-                if cnt > len(SERVER_ADDRESSES) // 2:
-                    for server_id, url in SERVER_ADDRESSES.items():
-                        if server_id != self.server_id:
-                            try:
-                                response = requests.post(
-                                    f"{url}/repl",
-                                    json={
-                                        "leader_id": self.server_id,
-                                        "term": self.term,
-                                        "commit": "yes"
-                                    },
-                                    timeout=1
-                                )
-                            except requests.exceptions.RequestException:
-                                pass
-                    logger.info(f"Commited {len(self.log[cur_len - 1:])} entries")
-                    return jsonify(
-                        {
-                            "status": "ok"
-                        }
-                    )
-                else:
-                    del self.change_log[key]
-                    self.log.pop()
-                    return jsonify(
-                        {
-                            "status": "error", 
-                            "message": "Not enough servers ack"
+                            "status": "error",
+                            "message": results[0]["message"]
                         }
                     )
+                index = self.propose(writes[0])
+            return self.commit_response(index)
+
+
+    def batch(self):
+        data = request.get_json(silent=True)
+        ops = data.get("ops", []) if isinstance(data, dict) else None
+        if not valid_ops(ops):
             return jsonify(
                 {
-                    "status": "error", 
-                    "message": "Key not found"
+                    "status": "error",
+                    "message": "ops must be a list of objects with op and key"
+                }
+            ), 400
+
+        if self.state != "leader":
+            self.registry.inc("raft_forwarded_requests_total", route="/batch")
+            try:
+                response = self.peers.post(
+                    self.leader_id,
+                    "/batch",
+                    json={"ops": ops},
+                    timeout=FORWARD_TIMEOUT
+                )
+                return jsonify(response.json())
+            except requests.RequestException as e:
+                return jsonify(
+                    {
+                        "status": "error",
+                        "message": str(e)
+                    }
+                )
+
+        if not ops or len(ops) > BATCH_MAX_OPS:
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": f"A batch takes 1 to {BATCH_MAX_OPS} ops"
+                }
+            )
+
+        with self.lock:
+            writes, results = self.check_batch(ops)
+            if writes is None:
+                return jsonify(
+                    {
+                        "status": "error",
+                        "message": "Transaction aborted",
+                        "results": results
+                    }
+                )
+            # one log entry: replicated in one round, applied all at once
+            index = self.propose({"type": "batch", "key": None, "ops": writes})
+
+        response = self.commit_response(index)
+        reply = response.get_json()
+        if reply["status"] != "ok":
+            return response
+        reply["results"] = results
+        return jsonify(reply)
+
+
+    def check_batch(self, ops):
+        """Resolve a batch against the newest log state, the caller holds
+        self.lock. Returns the writes to log and per-op results, or None
+        and the results if any op fails."""
+        # key -> (value, revision) after the batch's own writes so far; a
+        # key written earlier in the batch has no revision yet
+        pending = dict()
+
+        def current(key):
+            return pending[key][0] if key in pending else self.latest_value(key)
+
+        def revision(key):
+            return pending[key][1] if key in pending else self.latest_revision(key)
+
+        writes, results = [], []
+        for op in ops:
+            kind, key = op.get("op"), op.get("key")
+            if kind not in ("put", "delete", "update"):
+                error = f"Unknown op {kind!r}"
+            elif key is None:
+                error = "Missing key"
+            elif kind == "put" and not valid_ttl(op.get("ttl")):
+                error = "Invalid ttl"
+            elif not valid_revision(op.get("if_revision")):
+                error = "if_revision must be a non-negative integer"
+            elif kind != "put" and current(key) is None:
+                error = "Key not found"
+            elif op.get("if_revision") is not None and revision(key) != op["if_revision"]:
+                error = "Revision has changed"
+            elif kind == "update" and ("old" in op or op.get("if_revision") is None) and current(key) != op.get("old"):
+                error = "Value has been changed"
+            else:
+                error = None
+
+            if error:
+                results.append({"status": "error", "message": error})
+                continue
+            if kind == "delete":
+                writes.append({"type": "delete", "key": key})
+                pending[key] = (None, None)
+            else:
+                writes.append(self.put_entry(key, op.get("value"), op.get("ttl")))
+                pending[key] = (op.get("value"), None)
+            results.append({"status": "ok"})
+
+        if any(result["status"] != "ok" for result in results):
+            for result in results:
+                if result["status"] == "ok":
+                    result["status"] = "aborted"
+            return None, results
+        return writes, results
+
+
+    @staticmethod
+    def put_entry(key, value, ttl=None):
+        entry = {"type": "put", "key": key, "value": value}
+        if ttl is not None:
+            # absolute, so every replica expires the key at the same moment
+            entry["expires_at"] = time.time() + ttl
+        return entry
+
+
+    def recover(self):
+        """Rebuild log, term, votes and the state machine from the WAL."""
+        start = time.time()
+        snapshot = self.snapshots.load()
+        if snapshot:
+            with self.apply_lock:
+                self.restore_snapshot(json.loads(snapshot))
+
+        commit_index = self.commit_index
+        for record in self.wal.replay():
+            op = record["op"]
+            if op == "append":
+                index = record.get("index", len(self.log) + 1)
+                # already folded into the snapshot
+                if index <= self.log.offset:
+                    continue
+                if index <= len(self.log):
+                    self.truncate_log(index - 1, persist=False)
+                self.append_entry(record["entry"], persist=False)
+            elif op == "truncate":
+                if record["index"] >= self.log.offset:
+                    self.truncate_log(record["index"], persist=False)
+            elif op == "term":
+                self.term = record["term"]
+            elif op == "vote":
+                self.votes_by_term[record["term"]] = record["candidate_id"]
+            elif op == "commit":
+                commit_index = record["index"]
+
+        self.durable_index = len(self.log)
+        self.commit_index = min(commit_index, len(self.log))
+        self.apply_committed()
+        if len(self.log):
+            logger.info(
+                "Recovered %d entries, term %d, commit %d in %.3fs",
+                len(self.log), self.term, self.commit_index, time.time() - start
+            )
+
+
+    def save_term(self, term):
+        with self.term_lock:
+            if term > self.term:
+                self.term = term
+                self.wal.append({"op": "term", "term": term})
+                self.wal.sync()
+
+
+    def save_vote(self, term, candidate_id):
+        with self.term_lock:
+            self.votes_by_term[term] = candidate_id
+            self.wal.append({"op": "vote", "term": term, "candidate_id": candidate_id})
+            self.wal.sync()
+
+
+    def follow(self, term):
+        """Accept a leader's term; False if the leader is behind us."""
+        with self.term_lock:
+            if term < self.term:
+                return False
+            self.save_term(term)
+            self.state = "follower"
+            return True
+
+
+    @staticmethod
+    def entry_writes(entry):
+        """The single-key writes an entry makes, in order."""
+        if entry["type"] in ("batch", "expire"):
+            return entry["ops"]
+        if entry.get("key") is None:
+            return []
+        return [entry]
+
+
+    def append_entry(self, entry, persist=True):
+        self.log.append(entry)
+        self.index_entry(len(self.log), entry)
+        if persist:
+            self.wal.append({"op": "append", "index": len(self.log), "entry": entry})
+
+
+    def index_entry(self, pos, entry):
+        """Point key_index and write_slots at the writes of entry pos."""
+        writes = self.entry_writes(entry)
+        for slot, write in enumerate(writes):
+            key = intern_key(write["key"])
+            self.key_index[key] = pos
+            if len(writes) > 1:
+                self.write_slots[key] = slot
+            else:
+                self.write_slots.pop(key, None)
+
+
+    def truncate_log(self, index, persist=True):
+        """Drop log entries after index and repair key_index for them."""
+        removed = {write["key"] for el in self.log[index:] for write in self.entry_writes(el)}
+        del self.log[index:]
+        self.decoded_entries = dict()
+        self.durable_index = min(self.durable_index, index)
+        if persist:
+            self.wal.append({"op": "truncate", "index": index})
+        for key in removed:
+            self.key_index.pop(key, None)
+            self.write_slots.pop(key, None)
+        for i in range(len(self.log) - 1, self.log.offset - 1, -1):
+            if not removed:
+                break
+            writes = self.entry_writes(self.log[i])
+            for slot in range(len(writes) - 1, -1, -1):
+                key = writes[slot]["key"]
+                if key in removed:
+                    self.key_index[key] = i + 1
+                    if len(writes) > 1:
+                        self.write_slots[key] = slot
+                    removed.discard(key)
+        # the previous write of what is left is inside the snapshot
+        for key in removed:
+            if key in self.change_log:
+                self.key_index[key] = self.log.offset
+
+
+    def term_at(self, index):
+        if index <= 0 or index > len(self.log):
+            return 0
+        if index <= self.log.offset:
+            # only the boundary term is known once entries are compacted
+            return self.log.offset_term if index == self.log.offset else None
+        return self.log.term(index - 1)
+
+
+    def latest_write(self, key):
+        """The newest put of key in the log, committed or not, or None if
+        its newest write deletes it."""
+        pos = self.key_index.get(key)
+        if pos is None:
+            return None
+        if pos <= self.log.offset:
+            if key not in self.change_log:
+                return None
+            write = {"type": "put", "key": key, "value": self.change_log[key]}
+            if key in self.expiry:
+                write["expires_at"] = self.expiry[key]
+            return write
+        write = self.stored_writes(pos)[self.write_slots.get(key, 0)]
+        if write["type"] == "delete":
+            return None
+        return write
+
+
+    def stored_writes(self, pos):
+        """entry_writes of log entry pos, the caller holds self.lock."""
+        writes = self.decoded_entries.get(pos)
+        if writes is None:
+            writes = self.entry_writes(self.log[pos - 1])
+            if len(writes) > 1:
+                self.decoded_entries[pos] = writes
+                if len(self.decoded_entries) > DECODED_ENTRIES:
+                    del self.decoded_entries[next(iter(self.decoded_entries))]
+        return writes
+
+
+    def latest_value(self, key):
+        write = self.latest_write(key)
+        if write is None or write.get("expires_at", float("inf")) <= time.time():
+            return None
+        return write["value"]
+
+
+    def latest_revision(self, key):
+        """Revision of latest_value(key), 0 if there is none."""
+        if self.latest_value(key) is None:
+            return 0
+        pos = self.key_index[key]
+        # compacted writes are applied, and key_index only approximates them
+        return pos if pos > self.log.offset else self.revisions.get(key, 0)
+
+
+    def expired(self, key):
+        return self.expiry.get(key, float("inf")) <= time.time()
+
+
+    def apply_entry(self, index, entry):
+        for write in self.entry_writes(entry):
+            key = intern_key(write["key"])
+            self.expiring.discard(key)
+            if write.get("expires_at") is not None:
+                self.expiry[key] = write["expires_at"]
+                self.timers.schedule(key, write["expires_at"])
+            else:
+                self.expiry.pop(key, None)
+            if write["type"] == "put":
+                self.change_log[key] = write["value"]
+                # after the value: local_read takes the revision first, so
+                # it never pairs an old value with a newer revision
+                self.revisions[key] = index
+                if isinstance(key, str):
+                    self.ordered_keys.add(key)
+            if write["type"] == "delete":
+                self.change_log.pop(key, None)
+                self.revisions.pop(key, None)
+                if isinstance(key, str):
+                    self.ordered_keys.discard(key)
+
+
+    def apply_committed(self):
+        """Apply committed entries in order. Only the apply thread calls
+        this once the server runs, so change_log has a single writer."""
+        with self.apply_lock:
+            with self.lock:
+                start, end = self.last_applied, self.commit_index
+                if end <= start:
+                    return
+                entries = self.log[start:end]
+            # writers keep appending to the log meanwhile
+            for index, entry in enumerate(entries, start + 1):
+                self.apply_entry(index, entry)
+            if self.watchers:
+                self.publish(start + 1, entries)
+            with self.lock:
+                self.last_applied = end
+                # not synced on its own: replay only needs a lower bound
+                self.wal.append({"op": "commit", "index": end})
+                self.applied.notify_all()
+
+
+    def publish(self, first_index, entries):
+        for index, entry in enumerate(entries, first_index):
+            for position, write in enumerate(self.entry_writes(entry)):
+                for watcher in self.watchers:
+                    if watcher.matches(write["key"]):
+                        watcher.offer(self.watch_event(index, position, write))
+
+
+    @staticmethod
+    def watch_event(index, position, write):
+        # position tells apart the writes of one batch entry
+        event = {"index": index, "position": position, "type": write["type"], "key": write["key"]}
+        if write["type"] == "put":
+            event["value"] = write["value"]
+        return event
+
+
+    def expire_round(self):
+        """Move keys whose ttl ended to expiring; the leader then deletes up
+        to TTL_EXPIRE_BATCH of them with one replicated expire entry."""
+        now = time.time()
+        with self.apply_lock:
+            for key in self.timers.advance(now):
+                # written again since, its new expiry has its own slot
+                if self.expiry.get(key, float("inf")) <= now:
+                    self.expiring.add(key)
+            if self.state != "leader" or not self.expiring:
+                return
+            keys = list(islice(self.expiring, TTL_EXPIRE_BATCH))
+
+        with self.lock:
+            if self.expire_index > self.last_applied:
+                return
+            # skip keys whose newest write, applied or not, replaced the
+            # expired value; applying that write takes them off expiring
+            ops = [
+                {"type": "delete", "key": key} for key in keys
+                if (self.latest_write(key) or {}).get("expires_at", float("inf")) <= now
+            ]
+            if not ops:
+                return
+            index = self.propose({"type": "expire", "key": None, "ops": ops})
+            if index is None:
+                return
+            self.expire_index = index
+        self.persist(index)
+
+
+    def run_expiry(self):
+        while True:
+            self.deadimitation()
+            time.sleep(TTL_RESOLUTION)
+            self.expire_round()
+
+
+    def run_apply(self):
+        while True:
+            with self.committed:
+                self.committed.wait_for(lambda: self.commit_index > self.last_applied)
+            self.apply_committed()
+
+
+    def propose(self, entry):
+        """Append a client entry on the leader and kick the replicators."""
+        with self.lock:
+            if self.state != "leader" or self.transferring():
+                return None
+            entry["term"] = self.leader_term
+            self.append_entry(entry)
+            index = len(self.log)
+        for replicator in self.replicators.values():
+            replicator.notify()
+        return index
+
+
+    def persist(self, index):
+        """Make our own copy of the entry durable, then count it."""
+        self.wal.sync()
+        with self.lock:
+            self.durable_index = max(self.durable_index, min(index, len(self.log)))
+        self.advance_commit()
+
+
+    def wait_applied(self, index, timeout=COMMIT_TIMEOUT):
+        term = self.term_at(index)
+        deadline = time.time() + timeout
+        with self.applied:
+            while self.last_applied < index:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.state != "leader":
+                    return False
+                self.applied.wait(remaining)
+            # a new leader may have overwritten our entry before it committed
+            return self.term_at(index) == term
+
+
+    def replicate_write(self, entry):
+        return self.commit_response(self.propose(entry))
+
+
+    def commit_response(self, index):
+        started = time.perf_counter()
+        if index is not None:
+            self.persist(index)
+        if index is not None and self.wait_applied(index):
+            self.registry.observe("raft_commit_seconds", time.perf_counter() - started)
+            return jsonify(
+                {
+                    "status": "ok",
+                    "index": index,
+                    # the revision of every key the entry wrote
+                    "revision": index
+                }
+            )
+        self.registry.inc("raft_commit_failures_total")
+        if index is None:
+            # never appended, safe for the client to send again
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Not the leader"
                 }
             )
+        return jsonify(
+            {
+                "status": "error",
+                "message": "Not enough servers ack"
+            }
+        )
+
+
+    def advance_commit(self):
+        with self.lock:
+            if self.state != "leader":
+                return
+            matched = sorted(
+                [self.durable_index] + [self.match_index.get(server_id, 0) for server_id in self.replicators],
+                reverse=True
+            )
+            index = matched[len(SERVER_ADDRESSES) // 2]
+            # only entries from the current term are committed by counting replicas
+            if index > self.commit_index and self.term_at(index) == self.leader_term:
+                self.commit_index = index
+                self.committed.notify()
+
+
+    def append_message(self, server_id, prev_log_index, entries):
+        return {
+            "leader_id": self.server_id,
+            "term": self.leader_term,
+            "prev_log_index": prev_log_index,
+            "prev_log_term": self.term_at(prev_log_index),
+            "entries": entries,
+            "leader_commit": self.commit_index,
+        }
+
+
+    def next_batch(self, server_id):
+        with self.lock:
+            if self.state != "leader":
+                return None
+            next_index = self.next_index.get(server_id, len(self.log) + 1)
+            if next_index > len(self.log) or next_index <= self.log.offset:
+                return None
+            entries = self.log[next_index - 1:next_index - 1 + REPLICATION_BATCH_SIZE]
+            # optimistic: the next batch goes out before this one is acked
+            self.next_index[server_id] = next_index + len(entries)
+            return self.append_message(server_id, next_index - 1, entries)
+
+
+    def heartbeat_message(self, server_id):
+        with self.lock:
+            prev_log_index = max(self.match_index.get(server_id, 0), self.log.offset)
+            return self.append_message(server_id, prev_log_index, [])
+
+
+    def needs_snapshot(self, server_id):
+        with self.lock:
+            return self.state == "leader" and self.next_index.get(server_id, len(self.log) + 1) <= self.log.offset
+
+
+    def handle_snapshot_installed(self, server_id, index):
+        with self.lock:
+            self.match_index[server_id] = max(self.match_index.get(server_id, 0), index)
+            self.next_index[server_id] = max(self.next_index.get(server_id, 1), index + 1)
+        self.advance_commit()
+        self.replicators[server_id].notify()
+
+
+    def confirm_leadership(self):
+        """Check with a majority that we are still the leader.
+
+        A read may only use a round that started after the read arrived;
+        reads that come in while a round is running wait for the next one
+        and share it.
+        """
+        arrived = time.monotonic()
+        deadline = arrived + READ_TIMEOUT
+        while self.state == "leader" and time.monotonic() < deadline:
+            with self.read_rounds:
+                if self.confirmed_at >= arrived:
+                    return True
+                if self.read_round_running:
+                    self.read_rounds.wait(deadline - time.monotonic())
+                    continue
+                self.read_round_running = True
+
+            started = time.monotonic()
+            ok = False
+            try:
+                ok = self.broadcast(
+                    "/heartbeat",
+                    {server_id: self.heartbeat_message(server_id) for server_id in self.replicators},
+                    self.handle_append_response,
+                    self.post_append
+                )
+            finally:
+                with self.read_rounds:
+                    self.read_round_running = False
+                    if ok:
+                        self.confirmed_at = max(self.confirmed_at, started)
+                        self.lease_expiry = max(self.lease_expiry, started + LEASE_DURATION)
+                    self.read_rounds.notify_all()
+        return False
+
+
+    def leader_read_index(self):
+        """Commit index that is safe to serve linearizable reads at, or None."""
+        deadline = time.time() + READ_TIMEOUT
+        with self.applied:
+            # the commit index is only known to be current once an entry
+            # from our own term (the election noop) has committed
+            while self.term_at(self.commit_index) != self.leader_term:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.state != "leader":
+                    return None
+                self.applied.wait(remaining)
+            index = self.commit_index
+
+        if READ_MODE == "lease" and time.monotonic() < self.lease_expiry:
+            return index
+        if not self.confirm_leadership():
+            return None
+        return index
+
+
+    def wait_local_applied(self, index, timeout=READ_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.applied:
+            while self.last_applied < index:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.applied.wait(remaining)
+        return True
+
+
+    def read_barrier(self):
+        """Block until the local state machine is safe to read linearizably."""
+        if not self.alive:
+            return False
+        if self.state == "leader":
+            index = self.leader_read_index()
+        else:
+            if self.leader_id is None:
+                return False
+            try:
+                index = self.peers.get(self.leader_id, "/read_index").json().get("read_index")
+            except requests.exceptions.RequestException:
+                return False
+        return index is not None and self.wait_local_applied(index)
+
+
+    def local_read(self, key, head=False, stale=False):
+        if stale and READ_FALLBACK != "stale":
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Could not confirm the read index with the leader"
+                }
+            )
+        revision = self.revisions.get(key)
+        found = key in self.change_log and not self.expired(key)
+        if head:
+            response = {"status": "exists" if found else "not found"}
+        else:
+            response = {"key": key, "value": self.change_log.get(key) if found else None}
+        response["revision"] = revision if found else None
+        if stale:
+            response["stale"] = True
+        return jsonify(response)
+
+
+    def scan(self):
+        params = scan_params(request.get_json(silent=True) or {})
+        if isinstance(params, str):
+            return jsonify({"status": "error", "message": params})
+
+        if self.state == "leader":
+            # like point reads: hand scans to a replica that has applied
+            # everything committed
+            for server_id in self.replicators:
+                if self.versions[server_id] >= self.commit_index > 0:
+                    return jsonify({"id": server_id}), 302
+
+        stale = not self.read_barrier()
+        if stale and READ_FALLBACK != "stale":
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Could not confirm the read index with the leader"
+                }
+            )
+        trailer = {"version": self.last_applied}
+        if stale:
+            trailer["stale"] = True
+        return stream_scan([self.scan_items(params)], params["limit"], trailer)
+
+
+    def scan_items(self, params):
+        """(key, value, revision) in key order. Each chunk is read under
+        apply_lock, so it matches one applied version."""
+        start, inclusive = params["start"], params["inclusive"]
+        while True:
+            with self.apply_lock:
+                keys = self.ordered_keys.page(start, inclusive, SCAN_CHUNK)
+                items = [
+                    (key, self.change_log.get(key), self.revisions.get(key))
+                    for key in keys if not self.expired(key)
+                ]
+            for key, value, revision in items:
+                if params["end"] is not None and key >= params["end"]:
+                    return
+                if not key.startswith(params["prefix"]):
+                    return
+                yield key, value, revision
+            if len(keys) < SCAN_CHUNK:
+                return
+            start, inclusive = keys[-1], False
+
+
+    def watch(self):
+        """Server-sent events for the committed writes to a key or prefix.
+
+        Query: key or prefix, and from_index (default: only new writes).
+        A reconnecting EventSource resumes after its Last-Event-ID. Any
+        replica serves watches from its own applied log.
+        """
+        args = request.args
+        key, prefix = args.get("key"), args.get("prefix")
+        if (key is None) == (prefix is None):
+            return jsonify({"status": "error", "message": "Watch takes either key or prefix"}), 400
+        try:
+            if "Last-Event-ID" in request.headers:
+                from_index = int(request.headers["Last-Event-ID"]) + 1
+            else:
+                from_index = int(args["from_index"]) if "from_index" in args else None
+            if from_index is not None and from_index < 0:
+                raise ValueError(from_index)
+        except ValueError:
+            return jsonify({"status": "error", "message": "from_index and Last-Event-ID must be non-negative integers"}), 400
+
+        with self.apply_lock:
+            if len(self.watchers) >= WATCH_MAX:
+                return jsonify({"status": "error", "message": "Too many watchers"}), 503
+            watcher = Watcher(key, prefix)
+            # everything after this index arrives through the watcher's queue
+            registered = self.last_applied
+            self.watchers.add(watcher)
+
+        if from_index is None:
+            from_index = registered + 1
+        if from_index <= min(registered, self.log.offset):
+            with self.apply_lock:
+                self.watchers.discard(watcher)
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Log compacted, read the current state and watch from snapshot_index + 1",
+                    "snapshot_index": self.log.offset
+                }
+            ), 410
+
+        return Response(self.watch_stream(watcher, from_index, registered), mimetype="text/event-stream")
+
+
+    def watch_stream(self, watcher, from_index, registered):
+        def sse(event, name=None):
+            lines = [f"id: {event['index']}", f"event: {name or event['type']}", f"data: {json.dumps(event)}"]
+            return "\n".join(lines) + "\n\n"
+
+        try:
+            # catch up from the log, then switch to live events
+            index = from_index
+            while index <= registered:
+                with self.lock:
+                    if index <= self.log.offset:
+                        yield sse({"index": index - 1, "snapshot_index": self.log.offset}, "compacted")
+                        return
+                    entries = self.log[index - 1:min(registered, index - 1 + SCAN_CHUNK)]
+                for i, entry in enumerate(entries, index):
+                    for position, write in enumerate(self.entry_writes(entry)):
+                        if watcher.matches(write["key"]):
+                            yield sse(self.watch_event(i, position, write))
+                index += len(entries)
+
+            while True:
+                if watcher.overflowed and watcher.events.empty():
+                    # the client resumes from the log where we stopped; writes
+                    # of that entry it already has repeat
+                    yield sse({"index": watcher.dropped_from - 1}, "overflow")
+                    return
+                try:
+                    event = watcher.events.get(timeout=WATCH_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["index"] >= from_index:
+                    yield sse(event)
+        finally:
+            with self.apply_lock:
+                self.watchers.discard(watcher)
+
+
+    def read_index(self):
+        self.deadimitation()
+
+        if self.state != "leader":
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Not the leader",
+                    "leader_id": self.leader_id
+                }
+            )
+        index = self.leader_read_index()
+        if index is None:
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Lost leadership"
+                }
+            )
+        return jsonify(
+            {
+                "status": "ok",
+                "read_index": index,
+                "term": self.term
+            }
+        )
+
+
+    def post_append(self, server_id, path, message):
+        if self.peer_codecs[server_id] != "frame":
+            return self.peers.post(server_id, path, json=message)
+        response = self.peers.post(
+            server_id,
+            path,
+            data=FrameCodec.encode(message),
+            headers={"Content-Type": FRAME_CONTENT_TYPE}
+        )
+        if response.status_code in (400, 415):
+            # the peer could not parse the frame, stay on JSON from now on
+            self.peer_codecs[server_id] = "json"
+        return response
+
+
+    def read_append_request(self):
+        if request.mimetype == FRAME_CONTENT_TYPE:
+            return FrameCodec.decode(request.get_data())
+        return request.get_json()
+
+
+    def rewind_next_index(self, server_id, index):
+        with self.lock:
+            if server_id in self.next_index:
+                self.next_index[server_id] = max(1, min(self.next_index[server_id], index))
+
+
+    def handle_append_response(self, server_id, message, data):
+        """Returns True if the follower still accepts us as leader."""
+        if data.get("term", 0) > self.term:
+            self.step_down(data["term"])
+            return False
+        if message["term"] != self.term or self.state != "leader":
+            return False
+
+        if "last_applied" in data:
+            self.versions[server_id] = data["last_applied"]
+        if WIRE_FORMAT == "frame" and "frame" in data.get("codecs", ()):
+            self.peer_codecs[server_id] = "frame"
+
+        if data.get("success"):
+            with self.lock:
+                match = message["prev_log_index"] + len(message["entries"])
+                self.match_index[server_id] = max(self.match_index.get(server_id, 0), match)
+                self.next_index[server_id] = max(self.next_index.get(server_id, 1), match + 1)
+            self.advance_commit()
+            if server_id == self.transfer_target:
+                self.send_timeout_now()
+        else:
+            hint = data.get("next_index", message["prev_log_index"])
+            with self.lock:
+                # if we have the follower's conflicting term, our entries of
+                # it match; resend from the first one after them
+                if "conflict_term" in data:
+                    last = self.log.last_index_of(data["conflict_term"])
+                    if last is not None:
+                        hint = min(last + 1, message["prev_log_index"])
+                self.match_index[server_id] = min(self.match_index.get(server_id, 0), hint - 1)
+            self.rewind_next_index(server_id, hint)
+            self.replicators[server_id].notify()
+        return True
+
+
+    def append_entries(self, data):
+        leader_id = data.get("leader_id")
+        term = data.get("term")
+
+        if not self.follow(term):
+            return {"status": "bad", "success": False, "term": self.term}
+
+        if leader_id is not None:
+            self.last_heartbeat_time = time.time()
+            self.reset_election_timer()
+            if leader_id != self.leader_id:
+                with self.lock:
+                    self.leader_id = leader_id
+                    # wakes a leadership transfer waiting for its target
+                    self.applied.notify_all()
+
+        prev_log_index = data.get("prev_log_index", 0)
+        prev_log_term = data.get("prev_log_term", 0)
+        entries = data.get("entries", [])
+
+        with self.lock:
+            if prev_log_index < self.log.offset:
+                # everything up to our snapshot is committed and therefore matches
+                entries = entries[self.log.offset - prev_log_index:]
+                prev_log_index, prev_log_term = self.log.offset, self.log.offset_term
+            if prev_log_index > len(self.log):
+                return self.append_reply(False, len(self.log) + 1)
+            conflict_term = self.term_at(prev_log_index)
+            if conflict_term != prev_log_term:
+                # the whole run of the conflicting term goes, not one entry
+                # per round trip
+                return self.append_reply(False, self.log.term_start(prev_log_index), conflict_term)
+
+            index = prev_log_index
+            for el in entries:
+                index += 1
+                if index <= len(self.log):
+                    if self.term_at(index) == el.get("term", 0):
+                        continue
+                    self.truncate_log(index - 1)
+                self.append_entry(el)
+
+            leader_commit = min(data.get("leader_commit", 0), index)
+            if leader_commit > self.commit_index:
+                self.commit_index = leader_commit
+                self.committed.notify()
+
+            reply = self.append_reply(True, len(self.log) + 1)
+
+        # entries must be on disk before the leader counts them
+        if entries:
+            self.wal.sync()
+        return reply
+
+
+    def append_reply(self, success, next_index, conflict_term=None):
+        reply = {
+            "status": "ok" if success else "bad",
+            "success": success,
+            "term": self.term,
+            "next_index": next_index,
+            "cur_len": len(self.log),
+            "last_applied": self.last_applied,
+            "codecs": ["json", "frame"],
+        }
+        if conflict_term is not None:
+            reply["conflict_term"] = conflict_term
+        return reply
+
+
+    def step_down(self, term):
+        with self.term_lock:
+            self.save_term(term)
+            if self.state == "leader":
+                logger.info("Server %d steps down in term %d", self.server_id, self.term)
+            self.state = "follower"
+        with self.lock:
+            self.applied.notify_all()
+
+
+    def become_leader(self, term):
+        self.wal.sync()
+        with self.term_lock:
+            # a newer term showed up while votes were counted
+            if self.term != term or self.state == "leader":
+                return False
+            with self.lock:
+                self.state = "leader"
+                self.leader_term = term
+                self.leader_id = self.server_id
+                self.durable_index = len(self.log)
+                self.expire_index = 0
+                self.transfer_target = None
+                for server_id in self.replicators:
+                    self.next_index[server_id] = len(self.log) + 1
+                    self.match_index[server_id] = 0
+        self.leading.set()
+        # commits entries left over from earlier terms
+        index = self.propose({"type": "noop", "key": None})
+        if index is not None:
+            self.persist(index)
+        return True
+
+
+    def wal_records(self):
+        """What the WAL has to keep once the latest snapshot is on disk."""
+        yield {"op": "term", "term": self.term}
+        for term, candidate_id in list(self.votes_by_term.items()):
+            if term >= self.term:
+                yield {"op": "vote", "term": term, "candidate_id": candidate_id}
+        for index in range(max(self.snapshot_index, self.log.offset) + 1, len(self.log) + 1):
+            yield {"op": "append", "index": index, "entry": self.log[index - 1]}
+        yield {"op": "commit", "index": self.commit_index}
+
+
+    def restore_snapshot(self, snapshot):
+        """Callers hold apply_lock."""
+        index, term = snapshot["last_index"], snapshot["last_term"]
+        with self.lock:
+            if index <= len(self.log) and index > self.log.offset and self.term_at(index) == term:
+                # our log already agrees with the snapshot, keep what follows it
+                self.log.compact(index, term)
+            else:
+                self.log.reset(index, term)
+            self.change_log = dict(snapshot["change_log"])
+            self.ordered_keys = SortedKeys(key for key in self.change_log if isinstance(key, str))
+            self.key_index = dict(snapshot["key_index"])
+            self.write_slots = dict()
+            # the snapshot clamps later writes to its index
+            for pos in range(index + 1, len(self.log) + 1):
+                self.index_entry(pos, self.log[pos - 1])
+            self.decoded_entries = dict()
+            self.revisions = dict(snapshot.get("revisions", []))
+            self.expiry = dict(snapshot.get("expiry", []))
+            self.timers = TimerWheel()
+            for key, expires_at in self.expiry.items():
+                self.timers.schedule(key, expires_at)
+            self.expiring = set()
+            self.snapshot_index, self.snapshot_term = index, term
+            self.commit_index = max(self.commit_index, index)
+            self.last_applied = index
+            self.durable_index = max(self.durable_index, index)
+            self.applied.notify_all()
+
+
+    def take_snapshot(self):
+        with self.apply_lock, self.lock:
+            index = self.last_applied
+            if index - self.snapshot_index < SNAPSHOT_THRESHOLD:
+                return
+            term = self.term_at(index)
+            change_log = list(self.change_log.items())
+            expiry = list(self.expiry.items())
+            revisions = list(self.revisions.items())
+            # keys deleted by the snapshot's writes are left out; positions
+            # past the snapshot are replayed from the WAL tail
+            key_index = [
+                (key, min(pos, index)) for key, pos in self.key_index.items()
+                if pos > index or key in self.change_log
+            ]
+            deleted = [key for key, pos in self.key_index.items() if pos <= index and key not in self.change_log]
+
+        start = time.time()
+        self.snapshots.save(json.dumps(
+            {
+                "last_index": index,
+                "last_term": term,
+                "change_log": change_log,
+                "key_index": key_index,
+                "expiry": expiry,
+                "revisions": revisions,
+            },
+            separators=(",", ":")
+        ).encode())
+
+        with self.lock:
+            self.snapshot_index, self.snapshot_term = index, term
+            keep_from = max(self.log.offset, index - SNAPSHOT_TRAILING_ENTRIES)
+            self.log.compact(keep_from, self.term_at(keep_from))
+            for key in deleted:
+                # unless written again since
+                if self.key_index.get(key, index + 1) <= index:
+                    del self.key_index[key]
+            self.write_slots = {
+                key: slot for key, slot in self.write_slots.items()
+                if self.key_index.get(key, 0) > keep_from
+            }
+            self.wal.rewrite(self.wal_records)
+        logger.info(
+            "Snapshot at %d with %d keys in %.3fs, log keeps %d entries",
+            index, len(change_log), time.time() - start, self.log.retained()
+        )
+
+
+    def run_snapshots(self):
+        while True:
+            self.deadimitation()
+            self.take_snapshot()
+            time.sleep(1)
+
+
+    def install_snapshot(self):
+        self.deadimitation()
+
+        args = request.args
+        term = int(args["term"])
+        if self.term > term:
+            return jsonify({"success": False, "term": self.term})
+
+        self.follow(term)
+        self.leader_id = int(args["leader_id"])
+        self.last_heartbeat_time = time.time()
+        self.reset_election_timer()
+
+        chunk = request.get_data()
+        with self.install_lock:
+            if not self.snapshots.receive((term, int(args["last_index"])), int(args["offset"]), chunk):
+                # the leader starts over from offset 0 on its next round
+                self.registry.inc("raft_snapshot_installs_total", result="out_of_order")
+                return jsonify({"success": False, "term": self.term})
+            if args.get("done") == "1":
+                # a snapshot we have already caught up past is dropped, so
+                # ours stays consistent with the WAL
+                if int(args["last_index"]) <= self.commit_index:
+                    self.snapshots.discard()
+                    self.registry.inc("raft_snapshot_installs_total", result="stale")
+                else:
+                    snapshot = json.loads(self.snapshots.finish())
+                    with self.apply_lock, self.lock:
+                        self.restore_snapshot(snapshot)
+                        self.wal.rewrite(self.wal_records)
+                    self.registry.inc("raft_snapshot_installs_total", result="installed")
+                    logger.info("Installed snapshot at %d from server %s", snapshot["last_index"], self.leader_id)
+
+        return jsonify({"success": True, "term": self.term})
 
 
     def turnon(self):
         self.alive = True
-        logger.info(f"is alive now in term: {self.term}")
+        self.awake.set()
+        logger.info("Server %d is alive now in term %d", self.server_id, self.term)
         return jsonify(
             {
                 "status": "ok"
@@ -411,7 +2634,8 @@ class RaftServer:
 
     def turnoff(self):
         self.alive = False
-        logger.info(f"is dead now")
+        self.awake.clear()
+        logger.info("Server %d is dead now", self.server_id)
         return jsonify(
             {
                 "status": "ok"
@@ -419,182 +2643,500 @@ class RaftServer:
         )
 
 
+    def broadcast(self, path, messages, handle, post=None):
+        """Send messages to all peers at once and return as soon as a majority
+        (counting this server) is reached, without waiting for slow peers."""
+        quorum = len(SERVER_ADDRESSES) // 2 + 1
+        done = threading.Condition()
+        counts = {"ok": 1, "replied": 0}
+        post = post or (lambda server_id, path, message: self.peers.post(server_id, path, json=message))
+
+        def call(server_id, message):
+            ok = False
+            try:
+                response = post(server_id, path, message)
+                ok = handle(server_id, message, response.json())
+            except requests.exceptions.RequestException as e:
+                logger.debug("%s to server %d failed: %s", path, server_id, e)
+            with done:
+                counts["replied"] += 1
+                if ok:
+                    counts["ok"] += 1
+                done.notify_all()
+
+        for server_id, message in messages.items():
+            self.fanout.submit(call, server_id, message)
+
+        with done:
+            done.wait_for(
+                lambda: counts["ok"] >= quorum or counts["replied"] == len(messages),
+                timeout=1
+            )
+            return counts["ok"] >= quorum
+
+
     def send_heartbeat(self):
         while True:
             self.deadimitation()
-
-            if self.state == "leader":
-                for server_id, url in SERVER_ADDRESSES.items():
-                    if server_id != self.server_id:
-                        try:
-                            response = requests.post(
-                                f"{url}/heartbeat",
-                                json={
-                                    "leader_id": self.server_id,
-                                    "term": self.term,
-                                },
-                                timeout=1
-                            )
-                            data = response.json()
-                            cur_len = data.get("cur_len")
-                            if cur_len < len(self.change_log):
-                                if cur_len == 0:
-                                    cur_len += 1
-                                response = requests.post(
-                                f"{url}/heartbeat",
-                                json={
-                                    "leader_id": self.server_id,
-                                    "term": self.term,
-                                    "change_log": list(self.log[cur_len - 1:])
-                                },
-                                timeout=1
-                                )
-                                self.versions[server_id] = response.json().get("cur_len")
-                        except requests.exceptions.RequestException:
-                            pass
-                self.last_heartbeat_time = time.time()
+            if self.state != "leader":
+                # cleared before the second look, so a become_leader in
+                # between still wakes us
+                self.leading.clear()
+                if self.state != "leader":
+                    self.leading.wait()
+                continue
+            self.heartbeat_round()
             time.sleep(HEARTBEAT_INTERVAL)
 
 
-    def start_election(self):
+    def heartbeat_round(self):
+        if self.state != "leader":
+            return
+        started = time.monotonic()
+        if self.broadcast(
+            "/heartbeat",
+            {server_id: self.heartbeat_message(server_id) for server_id in self.replicators},
+            self.handle_append_response,
+            self.post_append
+        ):
+            with self.read_rounds:
+                self.lease_expiry = max(self.lease_expiry, started + LEASE_DURATION)
+        for server_id, replicator in self.replicators.items():
+            if self.match_index.get(server_id, 0) < len(self.log):
+                replicator.notify()
+        self.last_heartbeat_time = time.time()
+        self.reset_election_timer()
+
+
+    def start_election(self, transfer=False):
         """Запуск выборов, если сервер стал кандидатом."""
 
-        votes = 0
+        with self.lock:
+            last_log_index = len(self.log)
+            last_log_term = self.term_at(last_log_index)
+        message = {
+            "candidate_id": self.server_id,
+            "term": self.term + 1,
+            "last_log_index": last_log_index,
+            "last_log_term": last_log_term
+        }
+        granted = lambda server_id, message, data: data.get("vote_granted")
+        if transfer:
+            # the leader asked for this election, voters must not stick to it
+            message["transfer"] = True
+
+        # PreVote: only bump the term if a majority would vote for us, so a
+        # server cut off from the leader cannot force it out on its return
+        started = time.perf_counter()
+        if not transfer and not self.broadcast(
+            "/vote",
+            {server_id: dict(message, pre_vote=True) for server_id in self.replicators},
+            granted
+        ):
+            self.registry.inc("raft_elections_total", result="pre_vote_lost")
+            logger.info("Server %d lost the pre-vote for term %d", self.server_id, message["term"])
+            return
+
+        with self.term_lock:
+            term = self.term + 1
+            self.save_term(term)
+            self.save_vote(term, self.server_id)
+        logger.info("Server %d votes for candidate %d", self.server_id, self.server_id)
+        message["term"] = term
+        elected = self.broadcast(
+            "/vote",
+            {server_id: message for server_id in self.replicators},
+            granted
+        )
 
-        self.term = self.term + 1
-        for server_id, url in SERVER_ADDRESSES.items():
+        won = elected and self.become_leader(term)
+        self.registry.observe("raft_election_seconds", time.perf_counter() - started)
+        self.registry.inc("raft_elections_total", result="won" if won else "lost")
+        if won:
+            logger.info("Server %d is elected as leader in term %d", self.server_id, term)
+
+
+    def reset_election_timer(self):
+        """Push the election back by a fresh random timeout."""
+        self.election_deadline = time.time() + self.rng.uniform(ELECTION_TIMEOUT_MIN, ELECTION_TIMEOUT_MAX)
+
+
+    def transferring(self):
+        return self.transfer_target is not None and time.time() < self.transfer_deadline
+
+
+    def begin_transfer(self, target=None):
+        """Stop taking writes and hand leadership to target, or to the
+        follower with the highest match_index, once it has our whole log.
+        Returns the target, or None if we are not the leader or a transfer
+        is already running."""
+        with self.lock:
+            if self.state != "leader" or not self.replicators or self.transferring():
+                return None
+            if target is None:
+                target = max(self.replicators, key=lambda server_id: self.match_index.get(server_id, 0))
+            self.transfer_target = target
+            self.transfer_deadline = time.time() + TRANSFER_TIMEOUT
+            self.timeout_now_sent = False
+        # the new leader may be elected before our lease runs out
+        with self.read_rounds:
+            self.lease_expiry = 0
+        logger.info("Server %d hands leadership to server %d", self.server_id, target)
+        self.replicators[target].notify()
+        self.send_timeout_now()
+        return target
+
+
+    def send_timeout_now(self):
+        """TimeoutNow to the transfer target once it has our whole log."""
+        with self.lock:
+            target = self.transfer_target
+            if (
+                target is None
+                or self.timeout_now_sent
+                or not self.transferring()
+                or self.match_index.get(target, 0) < len(self.log)
+            ):
+                return
+            # sent once; writes stay fenced until we step down or the
+            # transfer times out, so the target's log stays up to date
+            self.timeout_now_sent = True
+            message = {"leader_id": self.server_id, "term": self.leader_term}
+        self.post_timeout_now(target, message)
+
+
+    def post_timeout_now(self, server_id, message):
+        def send():
             try:
-                response = requests.post(
-                    f"{url}/vote",
-                    json={
-                        "candidate_id": self.server_id,
-                        "term": self.term
-                    },
-                    timeout=1
-                )
-                if response.json().get("vote_granted"):
-                    votes += 1
+                self.peers.post(server_id, "/timeout_now", json=message)
             except requests.exceptions.RequestException as e:
-                print(f'SERVER #{server_id} failed: {e}')
-                pass
+                logger.warning("TimeoutNow to server %d failed: %s", server_id, e)
 
-        if votes > len(SERVER_ADDRESSES) // 2:
-            self.state = "leader"
-            self.leader_id = self.server_id
-            logger.info(f"Server {self.server_id} is elected as leader!")
+        self.fanout.submit(send)
 
-        self.last_heartbeat_time = time.time()
 
+    def accept_timeout_now(self, data):
+        """Whether our current leader asked us to start an election now."""
+        return (
+            self.state == "follower"
+            and data.get("term") == self.term
+            and data.get("leader_id") == self.leader_id
+        )
 
-    def election_check(self):
 
-        while True:
-            self.deadimitation()
+    def timeout_now(self):
+        self.deadimitation()
 
-            if time.time() - self.last_heartbeat_time > self.election_timeout:
-                if self.state != "leader":
-                    logger.info(f"Server {self.server_id} starts election!")
-                    self.start_election()
+        data = request.get_json()
+        accepted = self.accept_timeout_now(data)
+        if accepted:
+            logger.info("Server %d starts election on TimeoutNow from %d", self.server_id, data["leader_id"])
+            threading.Thread(target=self.start_election, kwargs={"transfer": True}, daemon=True).start()
+        return jsonify({"success": accepted, "term": self.term})
+
+
+    def transfer(self, target=None):
+        """begin_transfer and wait to hear from the target as leader of a
+        newer term; the target on success, else None."""
+        started_term = self.term
+        target = self.begin_transfer(target)
+        if target is None:
+            return None
+        # stepping down only means the target asked for votes; it has won
+        # once its first heartbeat reaches us
+        with self.applied:
+            moved = self.applied.wait_for(
+                lambda: self.leader_id == target and self.term > started_term,
+                timeout=TRANSFER_TIMEOUT + HEARTBEAT_INTERVAL
+            )
+        self.registry.inc("raft_leadership_transfers_total", result="ok" if moved else "timeout")
+        return target if moved else None
 
-                self.election_timeout_start_time = time.time()
 
-            self.log_stats()
-            time.sleep(1)
+    def transfer_leadership(self):
+        """Hand leadership to {"server_id": id}, or to the most caught up
+        follower with no body."""
+        data = request.get_json(silent=True) or {}
+        target = data.get("server_id")
+        if target is not None and target not in self.replicators:
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "server_id must be another server of the cluster"
+                }
+            ), 400
+        if self.state != "leader":
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Not the leader",
+                    "leader_id": self.leader_id
+                }
+            )
+        if self.transferring():
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "A leadership transfer is already running",
+                    "transfer_target": self.transfer_target
+                }
+            ), 409
+        target = self.transfer(target)
+        if target is None:
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Leadership transfer timed out"
+                }
+            )
+        return jsonify(
+            {
+                "status": "ok",
+                "leader_id": target,
+                "term": self.term
+            }
+        )
 
 
-    def log_stats(self):
-        logger.info(
-            f'TERM: {self.term}, ID: {self.server_id}, State: {self.state}, ChangeLog: {self.log}, DB: {self.change_log.items()}, Buf: {self.buf}'
-        )
-        return
+    def preferred_leader(self):
+        if not PREFERRED_LEADERS:
+            return None
+        return PREFERRED_LEADERS[(self.shard or 0) % len(PREFERRED_LEADERS)]
 
 
-    def deadimitation(self):
-        while not self.alive:
-            time.sleep(0.5)
+    def balance_round(self):
+        """Move leadership to our preferred server if it has caught up."""
+        preferred = self.preferred_leader()
+        if self.state != "leader" or preferred in (None, self.server_id) or preferred not in self.replicators:
+            return
+        # a preferred server that is down or far behind keeps its turn
+        if self.match_index.get(preferred, 0) < self.commit_index:
+            return
+        self.transfer(preferred)
 
 
-    def heartbeat(self):
-        self.deadimitation()
+    def run_balancer(self):
+        while True:
+            self.deadimitation()
+            time.sleep(BALANCE_INTERVAL)
+            self.balance_round()
 
-        data = request.get_json()
-        leader_id = data.get("leader_id")
-        term = data.get("term")
 
-        if self.term > term:
-            return jsonify({"status": "bad"})
+    def election_check(self):
+        while True:
+            self.deadimitation()
+            # resets only push the deadline back, so sleeping until the one
+            # seen now and looking again wakes us once per timeout at most
+            delay = self.election_deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.election_round()
+            self.log_stats()
 
-        if self.term <= term:
-            self.state = "follower"
-            self.term = term
 
-        if leader_id is not None:
-            self.last_heartbeat_time = time.time()
-            self.leader_id = leader_id
+    def election_round(self):
+        if time.time() < self.election_deadline:
+            return
+        if self.state != "leader":
+            logger.info("Server %d starts election!", self.server_id)
+            self.start_election()
+        self.reset_election_timer()
+
+
+    def log_stats(self):
+        """A summary line every STATS_LOG_INTERVAL; sizes only, never contents."""
+        now = time.monotonic()
+        if now - self.stats_logged_at < STATS_LOG_INTERVAL or not logger.isEnabledFor(logging.INFO):
+            return
+        self.stats_logged_at = now
+        logger.info("stats", extra={"fields": self.summary()})
+
+
+    def summary(self):
+        return {
+            "server_id": self.server_id,
+            "shard": self.shard,
+            "term": self.term,
+            "state": self.state,
+            "leader_id": self.leader_id,
+            "log_entries": len(self.log),
+            "log_in_memory": self.log.retained(),
+            "snapshot_index": self.snapshot_index,
+            "commit_index": self.commit_index,
+            "last_applied": self.last_applied,
+            "keys": len(self.change_log),
+            "ttl_keys": len(self.expiry),
+            "watchers": len(self.watchers),
+        }
+
+
+    def debug(self):
+        """Page through the log or the keys: ?section=log&start=<index> or
+        ?section=keys&after=<key>, with limit. Only at LOG_LEVEL=DEBUG."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return jsonify({"status": "error", "message": "Set LOG_LEVEL=DEBUG to enable /debug"}), 404
+        args = request.args
+        section = args.get("section", "state")
+        try:
+            limit = min(int(args.get("limit", 100)), DEBUG_PAGE_MAX)
+            start = int(args["start"]) if section == "log" and "start" in args else None
+        except ValueError:
+            return jsonify({"status": "error", "message": "start and limit must be integers"}), 400
+
+        reply = self.summary()
+        if section == "log":
+            with self.lock:
+                first = self.log.offset + 1
+                start = max(first, start if start is not None else len(self.log) - limit + 1)
+                end = min(len(self.log), start + limit - 1)
+                reply["entries"] = [dict(self.log[index - 1], index=index) for index in range(start, end + 1)]
+            reply["next"] = end + 1 if end < len(self.log) else None
+        elif section == "keys":
+            # a key cursor, like /scan, so each page costs its own length
+            after = args.get("after")
+            with self.apply_lock:
+                keys = self.ordered_keys.page(after or "", after is None, limit)
+                items = [[key, self.change_log.get(key), self.expiry.get(key)] for key in keys]
+            reply["items"] = items
+            reply["next"] = keys[-1] if len(keys) == limit else None
+        elif section != "state":
+            return jsonify({"status": "error", "message": "section is state, log or keys"}), 400
+        return jsonify(reply)
+
+
+    def deadimitation(self):
+        self.awake.wait()
 
-        if "change_log" in data:
-            for el in  data.get("change_log"):
-                self.log.append(el)
-                if el["type"] == "put":
-                    self.change_log[el["key"]] = el["value"]
-                if el["type"] == "delete":
-                    del self.change_log[el["key"]]
 
-        #self.change_log = data.get("change_log")
+    def heartbeat(self):
+        self.deadimitation()
 
-        return jsonify({"status": "ok", "cur_len" : len(self.log)})
+        return jsonify(self.append_entries(self.read_append_request()))
 
 
     def vote(self):
         self.deadimitation()
 
-        data = request.get_json()
+        return jsonify(self.request_vote(request.get_json()))
+
+
+    def request_vote(self, data):
         candidate_id = data.get("candidate_id")
         term = data.get("term")
 
+        if data.get("pre_vote"):
+            return {"vote_granted": self.grant_pre_vote(data)}
+
+        # a leader lease is only safe if nobody else can be elected while we
+        # still hear from the current leader
+        if (
+            READ_MODE == "lease"
+            and not data.get("transfer")
+            and self.leader_id not in (None, candidate_id)
+            and time.time() - self.last_heartbeat_time < ELECTION_TIMEOUT_MIN
+        ):
+            return {"vote_granted": False}
+
         if term > self.term:
-            self.term = term
+            self.step_down(term)
 
         if self.server_id == candidate_id:
-            logger.info(f"Server {self.server_id} votes for candidate {candidate_id}")
-            return jsonify(
-                {
-                    "vote_granted": True
-                }
-            )
+            logger.info("Server %d votes for candidate %d", self.server_id, candidate_id)
+            return {"vote_granted": True}
 
-        if self.state == "follower":
-            if term in self.votes_by_term:
-                return jsonify({"vote_granted": False})
+        if not self.log_up_to_date(data):
+            return {"vote_granted": False}
 
-            self.last_heartbeat_time = time.time()
-            self.votes_by_term[term] = candidate_id
-            logger.info(f"Server {self.server_id} votes for candidate {candidate_id}")
+        # checking and recording the vote is one step, or two candidates
+        # asking at once could both get it
+        with self.term_lock:
+            granted = self.state == "follower" and term == self.term and term not in self.votes_by_term
+            if granted:
+                self.save_vote(term, candidate_id)
 
-            return jsonify(
-                {
-                    "vote_granted": True
-                }
-            )
+        if granted:
+            self.reset_election_timer()
+            logger.info("Server %d votes for candidate %d", self.server_id, candidate_id)
 
-        return jsonify(
-            {
-                "vote_granted": False
-            }
-        )
+            return {"vote_granted": True}
+
+        return {"vote_granted": False}
+
+
+    def grant_pre_vote(self, data):
+        """Would we vote for data's candidate? Changes neither term nor vote."""
+        if self.state == "leader" or data.get("term") < self.term:
+            return False
+        if (
+            self.leader_id not in (None, data.get("candidate_id"))
+            and time.time() - self.last_heartbeat_time < ELECTION_TIMEOUT_MIN
+        ):
+            return False
+        return self.log_up_to_date(data)
+
+
+    def log_up_to_date(self, data):
+        """Only vote for candidates whose log is at least as up to date as ours."""
+        with self.lock:
+            last_log_index = len(self.log)
+            last_log_term = self.term_at(last_log_index)
+        candidate_log = (data.get("last_log_term", 0), data.get("last_log_index", 0))
+        return candidate_log >= (last_log_term, last_log_index)
 
 
     def status(self):
+        versions = dict(self.versions)
+        versions[self.server_id] = self.last_applied
         return jsonify(
             {
                 "state": self.state,
                 "leader_id": self.leader_id,
-                "term": self.term
+                "term": self.term,
+                "shard": self.shard,
+                "alive": self.alive,
+                "commit_index": self.commit_index,
+                "last_applied": self.last_applied,
+                # last_applied of every server as last reported to the leader
+                "versions": versions,
+                "watchers": len(self.watchers),
+                "ttl_keys": len(self.expiry),
+                "connections": self.peers.stats(),
+                "wire_formats": self.peer_codecs
             }
         )
 
 
-    def run(self):
+    async def run_timers(self):
+        """Heartbeat and election timers as coroutines on the event loop."""
+        loop = asyncio.get_running_loop()
+
+        async def every(interval, tick):
+            while True:
+                if self.alive:
+                    await loop.run_in_executor(None, tick)
+                await asyncio.sleep(interval)
+
+        async def elections():
+            while True:
+                delay = self.election_deadline - time.time()
+                if self.alive and delay <= 0:
+                    await loop.run_in_executor(None, self.election_round)
+                    self.log_stats()
+                else:
+                    await asyncio.sleep(delay if delay > 0 else HEARTBEAT_INTERVAL)
+
+        await asyncio.gather(
+            every(HEARTBEAT_INTERVAL, self.heartbeat_round),
+            elections()
+        )
+
+
+    async def serve_async(self, host="0.0.0.0", port=None):
+        return await serve_async(self.app, self.routes, host, port or self.port)
+
+
+    def start_threads(self):
         threading.Thread(
             target=self.send_heartbeat, 
             daemon=True
@@ -605,20 +3147,351 @@ class RaftServer:
             daemon=True
         ).start()
 
-        log = logging.getLogger('werkzeug')
-        log.setLevel(logging.WARNING)
+        self.start_background_threads()
+
+
+    def start_background_threads(self):
+        threading.Thread(
+            target=self.run_apply,
+            daemon=True
+        ).start()
+
+        for replicator in self.replicators.values():
+            threading.Thread(
+                target=replicator.run,
+                daemon=True
+            ).start()
+
+        threading.Thread(
+            target=self.run_snapshots,
+            daemon=True
+        ).start()
+
+        threading.Thread(
+            target=self.run_expiry,
+            daemon=True
+        ).start()
+
+        if PREFERRED_LEADERS:
+            threading.Thread(
+                target=self.run_balancer,
+                daemon=True
+            ).start()
+
+
+    def run(self):
+        serve(self.app, self.routes, [self], self.port)
+
+
+class ShardedNode:
+    """The SHARDS Raft groups one server takes part in, behind one port.
+
+    Group g serves its routes under /shard/<g>; the data routes at the root
+    pick the group owning the key, so any node accepts any key.
+    """
+
+    def __init__(self, server_id: int, shards=SHARDS, data_dir=WAL_DIR):
+        self.server_id = server_id
+        self.app = Flask(__name__)
+        self.groups = [
+            RaftServer(server_id, data_dir, shard=shard, app=self.app)
+            for shard in range(shards)
+        ]
+        self.port = self.groups[0].port
+        self.initialize_routes()
+
+
+    def initialize_routes(self):
+        routes = [
+            ("/status", self.status, ["GET"]),
+            ("/turnoff", self.turnoff, ["GET"]),
+            ("/turnon", self.turnon, ["GET"]),
+            ("/get_data", self.route("get_data"), ["GET"]),
+            ("/put_data", self.route("put_data"), ["PUT"]),
+            ("/post_data", self.route("post_data"), ["POST"]),
+            ("/delete_data", self.route("delete_data"), ["DELETE"]),
+            ("/head_data", self.route("head_data"), ["HEAD"]),
+            ("/update_data", self.route("update_data"), ["PATCH"]),
+            ("/batch", self.route("batch"), ["POST"]),
+            ("/scan", self.scan, ["GET"]),
+            ("/watch", self.watch, ["GET"]),
+            ("/metrics", self.metrics, ["GET"]),
+        ]
+        for rule, view_func, methods in routes:
+            self.app.add_url_rule(rule, view_func.__name__, view_func, methods=methods)
+        self.routes = routes + [route for group in self.groups for route in group.routes]
+
+
+    def route(self, name):
+        def view():
+            if name == "batch":
+                data = request.get_json(silent=True)
+                ops = data.get("ops", []) if isinstance(data, dict) else None
+                if not valid_ops(ops):
+                    # any group's view answers it with a 400
+                    return self.groups[0].views[name]()
+                keys = [op["key"] for op in ops]
+            else:
+                keys = [request.get_json().get("key")]
+            shards = {shard_for(key, len(self.groups)) for key in keys}
+            if len(shards) != 1:
+                return jsonify(
+                    {
+                        "status": "error",
+                        "message": "A batch must stay within one shard"
+                    }
+                )
+            # the group's view reads the same request
+            return self.groups[shards.pop()].views[name]()
+        view.__name__ = name
+        return view
+
+
+    def scan(self):
+        """Keys of one range are spread over all shards: scan each group
+        locally and merge the streams in key order."""
+        params = scan_params(request.get_json(silent=True) or {})
+        if isinstance(params, str):
+            return jsonify({"status": "error", "message": params})
+        stale = [not group.read_barrier() for group in self.groups]
+        if any(stale) and READ_FALLBACK != "stale":
+            return jsonify(
+                {
+                    "status": "error",
+                    "message": "Could not confirm the read index with the leader"
+                }
+            )
+        trailer = {"versions": [group.last_applied for group in self.groups]}
+        if any(stale):
+            trailer["stale"] = True
+        return stream_scan([group.scan_items(params) for group in self.groups], params["limit"], trailer)
+
 
-        self.app.run(
-            host="0.0.0.0", 
-            port=5000 + self.server_id, 
-            threaded=True
+    def watch(self):
+        """Log indexes are per group, so only key watches are routed here;
+        prefix watches go to each /shard/<g>/watch."""
+        key = request.args.get("key")
+        if key is None:
+            return jsonify({"status": "error", "message": "Watch a prefix on each /shard/<g>/watch"}), 400
+        return self.groups[shard_for(key, len(self.groups))].watch()
+
+
+    def status(self):
+        return jsonify(
+            {
+                "server_id": self.server_id,
+                "shards": [group.status().get_json() for group in self.groups]
+            }
         )
 
 
+    def metrics(self):
+        return render_metrics(sample for group in self.groups for sample in group.metric_samples())
+
+
+    def turnoff(self):
+        for group in self.groups:
+            group.turnoff()
+        return jsonify({"status": "ok"})
+
+
+    def turnon(self):
+        for group in self.groups:
+            group.turnon()
+        return jsonify({"status": "ok"})
+
+
+    def run(self):
+        serve(self.app, self.routes, self.groups, self.port)
+
+
+def valid_ttl(ttl):
+    if ttl is None:
+        return True
+    return type(ttl) in (int, float) and 0 < ttl < float("inf")
+
+
+def intern_key(key):
+    """Log entries are decoded afresh on every access, so without this the
+    key_index and the state machine would each hold their own copy of a key."""
+    return sys.intern(key) if isinstance(key, str) else key
+
+
+def valid_revision(revision):
+    return revision is None or (type(revision) is int and revision >= 0)
+
+
+def valid_ops(ops):
+    return isinstance(ops, list) and all(
+        isinstance(op, dict) and "op" in op and op.get("key") is not None for op in ops
+    )
+
+
+def scan_params(data):
+    """Validated /scan parameters, or an error message.
+
+    prefix: only keys starting with it; start: first key (inclusive);
+    end: stop before it; cursor: resume after the key a previous page
+    ended on; limit: keys per page.
+    """
+    prefix = data.get("prefix", "")
+    start = data.get("start")
+    end = data.get("end")
+    cursor = data.get("cursor")
+    limit = data.get("limit", 1000)
+    if not all(isinstance(value, str) for value in (prefix, start, end, cursor) if value is not None):
+        return "Scans cover string keys only"
+    if not isinstance(limit, int) or not 0 < limit <= SCAN_MAX_LIMIT:
+        return f"limit must be 1 to {SCAN_MAX_LIMIT}"
+    # keys below the prefix cannot match it
+    start = prefix if start is None else max(start, prefix)
+    if cursor is not None:
+        start = max(cursor, start)
+    return {
+        "prefix": prefix,
+        "start": start,
+        "inclusive": cursor is None or start != cursor,
+        "end": end,
+        "limit": limit,
+    }
+
+
+def stream_scan(sources, limit, trailer):
+    """Chunked NDJSON: one {"key", "value", "revision"} line per key, then the trailer
+    with the cursor for the next page (null once the range is done)."""
+    items = heapq.merge(*sources, key=lambda item: item[0])
+
+    def generate():
+        cursor = None
+        lines = []
+        for count, (key, value, revision) in enumerate(items):
+            if count == limit:
+                break
+            cursor = key
+            lines.append(json.dumps({"key": key, "value": value, "revision": revision}))
+            if len(lines) == SCAN_CHUNK:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        else:
+            cursor = None
+        lines.append(json.dumps(dict(trailer, cursor=cursor)))
+        yield "\n".join(lines) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def call_view(app, view_func, method, path, headers, body):
+    """Run a Flask view outside Werkzeug and return the Flask response."""
+    with app.test_request_context(path, method=method, headers=headers, data=body):
+        return app.make_response(view_func())
+
+
+def make_async_app(flask_app, routes):
+    """aiohttp application serving the routes from initialize_routes.
+
+    Views are synchronous (they wait on commits and peers), so they run
+    on a bounded thread pool instead of one thread per connection.
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=ASYNC_WORKERS,
+        thread_name_prefix="view"
+    )
+    # long-lived streams (/watch) wait for their next chunk here, so they
+    # cannot starve the views
+    streams = ThreadPoolExecutor(
+        max_workers=WATCH_MAX,
+        thread_name_prefix="stream"
+    )
+
+    def handler(view_func):
+        async def handle(request):
+            body = await request.read()
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                executor,
+                call_view,
+                flask_app,
+                view_func,
+                request.method,
+                request.path_qs,
+                list(request.headers.items()),
+                body
+            )
+            if response.is_streamed:
+                # /scan, /watch: send chunks as the generator yields them
+                stream = web.StreamResponse(
+                    status=response.status_code,
+                    headers={"Content-Type": response.headers["Content-Type"]}
+                )
+                await stream.prepare(request)
+                chunks = iter(response.response)
+                try:
+                    while True:
+                        chunk = await loop.run_in_executor(streams, next, chunks, None)
+                        if chunk is None:
+                            break
+                        await stream.write(chunk.encode() if isinstance(chunk, str) else chunk)
+                    await stream.write_eof()
+                finally:
+                    # runs the generator's cleanup when the client goes away
+                    response.close()
+                return stream
+            return web.Response(
+                body=response.get_data(),
+                status=response.status_code,
+                headers={"Content-Type": response.headers["Content-Type"]}
+            )
+        return handle
+
+    app = web.Application(client_max_size=max(SNAPSHOT_CHUNK_SIZE * 2, 64 << 20))
+    for rule, view_func, methods in routes:
+        for method in methods:
+            app.router.add_route(method, rule, handler(view_func))
+    return app
+
+
+async def serve_async(flask_app, routes, host, port):
+    runner = web.AppRunner(make_async_app(flask_app, routes), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def serve(app, routes, groups, port):
+    """Serve app and drive the groups' timers in the RUNTIME mode."""
+    if RUNTIME == "async":
+        if web is None:
+            raise RuntimeError("RUNTIME=async needs aiohttp: pip install aiohttp")
+        for group in groups:
+            group.start_background_threads()
+
+        async def run_async():
+            await serve_async(app, routes, "0.0.0.0", port)
+            await asyncio.gather(*(group.run_timers() for group in groups))
+
+        asyncio.run(run_async())
+        return
+
+    for group in groups:
+        group.start_threads()
+
+    log = logging.getLogger('werkzeug')
+    log.setLevel(logging.WARNING)
+
+    app.run(
+        host="0.0.0.0", 
+        port=port, 
+        threaded=True
+    )
+
+
 if __name__ == "__main__":
     print(
         'SERVER IS STARTING', 
         file=sys.stderr
     )
-    raft_server = RaftServer(SERVER_ID)
+    if SHARDS > 1:
+        raft_server = ShardedNode(SERVER_ID)
+    else:
+        raft_server = RaftServer(SERVER_ID)
     raft_server.run()
@@ -0,0 +1,347 @@
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+
+import server as raft
+from server import RaftServer
+
+
+class VirtualClock:
+    """Stands in for the time module inside server.py while a simulation runs."""
+
+    def __init__(self, start=1_000_000.0):
+        self.now = start
+
+
+    def time(self):
+        return self.now
+
+
+    monotonic = perf_counter = time
+
+
+    def sleep(self, seconds):
+        # nothing in a simulated server may block, events wait in the heap
+        raise RuntimeError("time.sleep inside the simulation")
+
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class NullApp:
+    """Routes are never served in a simulation, skip building a Flask app."""
+
+    def add_url_rule(self, *args, **kwargs):
+        pass
+
+
+class SimNetwork:
+    """Seeded message fate: per-message latency and drops, plus partitions
+    and crashed nodes that neither send nor receive."""
+
+    def __init__(self, rng, latency=(0.001, 0.01), drop_rate=0.0):
+        self.rng = rng
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.down = set()
+        # server id -> partition number, unset nodes share partition 0
+        self.groups = {}
+
+
+    def delay(self):
+        return self.rng.uniform(*self.latency)
+
+
+    def delivers(self, source, target):
+        if source in self.down or target in self.down:
+            return False
+        if self.groups.get(source, 0) != self.groups.get(target, 0):
+            return False
+        return self.rng.random() >= self.drop_rate
+
+
+class SimReplicator:
+    """Replicator without a thread: each send is an event and its reply
+    another one, up to REPLICATION_PIPELINE_DEPTH in flight."""
+
+    def __init__(self, sim, raft, server_id):
+        self.sim = sim
+        self.raft = raft
+        self.server_id = server_id
+        self.inflight = 0
+        self.scheduled = False
+
+
+    def notify(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.sim.schedule(0, self.run)
+
+
+    def run(self):
+        self.scheduled = False
+        if self.raft.server_id in self.sim.network.down:
+            return
+        while self.inflight < raft.REPLICATION_PIPELINE_DEPTH:
+            message = self.raft.next_batch(self.server_id)
+            if message is None:
+                return
+            self.inflight += 1
+            self.sim.send(self.raft.server_id, self.server_id, "/repl", message, self.replied)
+
+
+    def replied(self, message, data):
+        self.inflight -= 1
+        if data is None:
+            # what a timed out request does: resend from this batch later
+            self.raft.rewind_next_index(self.server_id, message["prev_log_index"] + 1)
+        else:
+            self.raft.handle_append_response(self.server_id, message, data)
+        self.notify()
+
+
+class SimServer(RaftServer):
+    """A RaftServer whose peers are other SimServers in the same process."""
+
+    def __init__(self, sim, server_id):
+        self.sim = sim
+        super().__init__(server_id, data_dir=None, app=NullApp())
+        # timeouts from the seed, not the staggered boot ones
+        self.rng = random.Random(sim.rng.random())
+        self.reset_election_timer()
+        self.replicators = {
+            server_id: SimReplicator(sim, self, server_id)
+            for server_id in self.replicators
+        }
+
+
+    def post_timeout_now(self, server_id, message):
+        self.sim.send(self.server_id, server_id, "/timeout_now", message, lambda message, data: None)
+
+
+    def broadcast(self, path, messages, handle, post=None):
+        # a round trip over the broadcast timeout counts as no answer
+        ok = 1
+        for server_id, message in messages.items():
+            data = self.sim.call(self.server_id, server_id, path, message, timeout=1)
+            if data is not None and handle(server_id, message, data):
+                ok += 1
+        return ok >= len(raft.SERVER_ADDRESSES) // 2 + 1
+
+
+class Simulator:
+    """size RaftServers in one process on a virtual clock.
+
+    Timers, message deliveries and replies are events in one heap, so a
+    run is a pure function of the seed: no threads, no sleeps, no
+    sockets. Safety invariants are checked after every event.
+
+        with Simulator(seed=7) as sim:
+            sim.run_until(sim.leader)
+            sim.partition({1, 2}, {3, 4, 5})
+            sim.run_for(30)
+    """
+
+    def __init__(self, size=5, seed=0, latency=(0.001, 0.01), drop_rate=0.0):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.network = SimNetwork(self.rng, latency, drop_rate)
+        self.events = []
+        self.sequence = itertools.count()
+        # term -> the server that led it, and index -> the entry applied
+        # there first, for the safety checks
+        self.leaders = {}
+        self.applied = {}
+
+
+    def __enter__(self):
+        self.saved = raft.time, dict(raft.SERVER_ADDRESSES), raft.logger.level
+        raft.time = self.clock
+        raft.SERVER_ADDRESSES.clear()
+        raft.SERVER_ADDRESSES.update({server_id: f"sim://{server_id}" for server_id in range(1, self.size + 1)})
+        raft.logger.setLevel(logging.WARNING)
+
+        self.nodes = {server_id: SimServer(self, server_id) for server_id in raft.SERVER_ADDRESSES}
+        for node in self.nodes.values():
+            # nodes do not boot in the same instant
+            self.schedule(node.election_deadline - self.clock.now, self.election_tick, node)
+            self.schedule(self.rng.uniform(0, raft.HEARTBEAT_INTERVAL), self.tick, node, "heartbeat_round", raft.HEARTBEAT_INTERVAL)
+        return self
+
+
+    def __exit__(self, *exc):
+        raft.time, addresses, level = self.saved
+        raft.SERVER_ADDRESSES.clear()
+        raft.SERVER_ADDRESSES.update(addresses)
+        raft.logger.setLevel(level)
+
+
+    def schedule(self, delay, fn, *args):
+        heapq.heappush(self.events, (self.clock.now + delay, next(self.sequence), fn, args))
+
+
+    def tick(self, node, timer, interval):
+        if node.server_id not in self.network.down:
+            getattr(node, timer)()
+        self.schedule(interval, self.tick, node, timer, interval)
+
+
+    def election_tick(self, node):
+        """election_check without the thread: wake at the node's deadline."""
+        if node.server_id in self.network.down:
+            self.schedule(1, self.election_tick, node)
+            return
+        node.election_round()
+        self.schedule(node.election_deadline - self.clock.now, self.election_tick, node)
+
+
+    def step(self):
+        at, _, fn, args = heapq.heappop(self.events)
+        self.clock.now = max(self.clock.now, at)
+        fn(*args)
+        # the apply thread's job
+        for node in self.nodes.values():
+            if node.commit_index > node.last_applied:
+                start = node.last_applied
+                node.apply_committed()
+                self.check_applied(node, start)
+        self.check_leaders()
+
+
+    def run_for(self, seconds):
+        deadline = self.clock.now + seconds
+        while self.events and self.events[0][0] <= deadline:
+            self.step()
+        self.clock.now = deadline
+
+
+    def run_until(self, predicate, timeout=60):
+        """Run until predicate() is truthy and return its value, or None
+        once timeout virtual seconds have passed."""
+        deadline = self.clock.now + timeout
+        while self.events and self.events[0][0] <= deadline:
+            result = predicate()
+            if result:
+                return result
+            self.step()
+        return predicate() or None
+
+
+    def deliver(self, target, path, message):
+        node = self.nodes[target]
+        # a copy, as if it had crossed the wire
+        message = json.loads(json.dumps(message))
+        if path == "/vote":
+            return node.request_vote(message)
+        if path == "/timeout_now":
+            accepted = node.accept_timeout_now(message)
+            if accepted:
+                self.schedule(0, node.start_election, True)
+            return {"success": accepted, "term": node.term}
+        return node.append_entries(message)
+
+
+    def call(self, source, target, path, message, timeout):
+        """A blocking request: handled at once if both legs of the round
+        trip get through in time, else None."""
+        if not self.network.delivers(source, target):
+            return None
+        if self.network.delay() + self.network.delay() > timeout:
+            return None
+        reply = self.deliver(target, path, message)
+        if not self.network.delivers(target, source):
+            return None
+        return reply
+
+
+    def send(self, source, target, path, message, callback):
+        """A pipelined request: delivered and answered as later events.
+        callback(message, reply) runs on reply, or with None after
+        PEER_READ_TIMEOUT if either leg is lost."""
+        if not self.network.delivers(source, target):
+            self.schedule(raft.PEER_READ_TIMEOUT, callback, message, None)
+            return
+
+        def arrive():
+            if target in self.network.down:
+                self.schedule(raft.PEER_READ_TIMEOUT, callback, message, None)
+                return
+            reply = self.deliver(target, path, message)
+            if self.network.delivers(target, source):
+                self.schedule(self.network.delay(), answer, reply)
+            else:
+                self.schedule(raft.PEER_READ_TIMEOUT, callback, message, None)
+
+        def answer(reply):
+            if source not in self.network.down:
+                callback(message, reply)
+
+        self.schedule(self.network.delay(), arrive)
+
+
+    def check_leaders(self):
+        """Election safety: at most one leader per term."""
+        for node in self.nodes.values():
+            if node.state == "leader":
+                leader = self.leaders.setdefault(node.term, node.server_id)
+                assert leader == node.server_id, f"servers {leader} and {node.server_id} both lead term {node.term}"
+
+
+    def check_applied(self, node, start):
+        """State machine safety: every server applies the same entry at an index."""
+        for index in range(start + 1, node.last_applied + 1):
+            entry = self.applied.setdefault(index, node.log[index - 1])
+            assert entry == node.log[index - 1], (
+                f"server {node.server_id} applied {node.log[index - 1]} at {index}, another server {entry}"
+            )
+
+
+    def leader(self):
+        """The server every live node can reach that leads the highest term."""
+        leaders = [
+            node for node in self.nodes.values()
+            if node.state == "leader" and node.server_id not in self.network.down
+        ]
+        return max(leaders, key=lambda node: node.term).server_id if leaders else None
+
+
+    def propose(self, key, value):
+        """Append a put on the current leader; returns its log index or None."""
+        leader = self.leader()
+        if leader is None:
+            return None
+        node = self.nodes[leader]
+        index = node.propose(node.put_entry(key, value))
+        if index is not None:
+            node.persist(index)
+        return index
+
+
+    def committed(self, index):
+        """Whether a majority of servers have applied index."""
+        applied = [node for node in self.nodes.values() if node.last_applied >= index]
+        return len(applied) > self.size // 2
+
+
+    def crash(self, server_id):
+        self.network.down.add(server_id)
+
+
+    def restart(self, server_id):
+        """Back with its log and term, like /turnon."""
+        self.network.down.discard(server_id)
+        self.nodes[server_id].last_heartbeat_time = self.clock.now
+        self.nodes[server_id].reset_election_timer()
+
+
+    def partition(self, *groups):
+        self.network.groups = {server_id: number for number, group in enumerate(groups) for server_id in group}
+
+
+    def heal(self):
+        self.network.groups = {}
@@ -1,7 +1,15 @@
 import unittest
 import json
 import time
+import threading
+import random
+import os
+import tempfile
+from unittest import mock
 import requests
+from client import AmbiguousWriteError, RaftClient, RaftClientError
+from server import FrameCodec, RaftLog, RaftServer, TimerWheel, WriteAheadLog
+from simulator import Simulator
 
 class TestRaftClusterIntegration(unittest.TestCase):
 
@@ -37,6 +45,22 @@ class TestRaftClusterIntegration(unittest.TestCase):
             data = response.json()
             self.assertEqual(data["value"], "bar")
 
+    def test_lone_surrogate_value_replicates(self):
+        client = RaftClient(self.servers)
+        response = requests.put(
+            f"{self.servers[self.find_leader(self.servers)]}/put_data",
+            data='{"key": "surrogate", "value": "\\ud800"}',
+            headers={"Content-Type": "application/json"}
+        )
+        self.assertEqual(response.json()["status"], "ok")
+
+        # replication to every follower keeps going after it
+        client.put("after-surrogate", "ok")
+        time.sleep(1)
+        for server in self.servers.values():
+            self.assertEqual(self.get_value(server, "surrogate"), "\ud800")
+            self.assertEqual(self.get_value(server, "after-surrogate"), "ok")
+
     def test_server_shutdown_and_recovery(self):
         requests.get(f"{self.servers[2]}/turnoff")
         time.sleep(1)
@@ -275,8 +299,680 @@ class TestRaftClusterIntegration(unittest.TestCase):
         data = response.json()
         self.assertEqual(data["value"], "bar")
 
+    def find_leader(self, candidates):
+        for server in candidates:
+            try:
+                status = requests.get(f"{self.servers[server]}/status", timeout=1).json()
+            except requests.RequestException:
+                continue
+            if status["state"] == "leader":
+                return server
+        return None
+
+    def wait_for_leader(self, candidates, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            leader = self.find_leader(candidates)
+            if leader is not None:
+                return leader
+            time.sleep(0.1)
+        return None
+
+    def test_lagging_follower_catches_up_from_snapshot(self):
+        client = RaftClient(self.servers)
+        leader = self.find_leader(self.servers)
+        follower = next(server for server in self.servers if server != leader)
+        requests.get(f"{self.servers[follower]}/turnoff")
+
+        # past the compose file's snapshot threshold, in many chunks
+        for i in range(300):
+            client.put(f"snap-{i}", f"{i}:" + "x" * 1000)
+        time.sleep(3)
+
+        requests.get(f"{self.servers[follower]}/turnon")
+        time.sleep(5)
+        metrics = requests.get(f"{self.servers[follower]}/metrics").text
+        self.assertIn('raft_snapshot_installs_total{result="installed"}', metrics)
+        for i in (0, 150, 299):
+            response = requests.get(f"{self.servers[follower]}/get_data", json={"key": f"snap-{i}"})
+            self.assertEqual(response.json()["value"], f"{i}:" + "x" * 1000)
+
+    def test_leadership_transfer(self):
+        leader = self.find_leader(self.servers)
+        self.assertIsNotNone(leader)
+        target = next(server for server in self.servers if server != leader)
+
+        start = time.time()
+        response = requests.post(f"{self.servers[leader]}/transfer_leadership", json={"server_id": target})
+        self.assertEqual(response.json()["status"], "ok")
+        self.assertEqual(response.json()["leader_id"], target)
+        print(f"leadership transfer: {time.time() - start:.3f}s")
+        self.assertEqual(self.wait_for_leader([target]), target)
+
+        response = requests.put(f"{self.servers[target]}/put_data", json={"key": "moved", "value": 1})
+        self.assertEqual(response.json()["status"], "ok")
+
+    def test_one_node_down_commit_and_election_latency(self):
+        leader = self.find_leader(self.servers)
+        self.assertIsNotNone(leader)
+        follower = next(server for server in self.servers if server != leader)
+
+        requests.get(f"{self.servers[follower]}/turnoff")
+        time.sleep(1)
+
+        # a dead follower must not add its timeout to every commit
+        latencies = []
+        for i in range(10):
+            start = time.time()
+            response = requests.put(f"{self.servers[leader]}/put_data", json={"key": f"lat{i}", "value": i})
+            latencies.append(time.time() - start)
+            self.assertEqual(response.json()["status"], "ok")
+        print(f"commit latency with one node down: avg {sum(latencies) / len(latencies):.3f}s, max {max(latencies):.3f}s")
+        self.assertLess(max(latencies), 1)
+
+        requests.get(f"{self.servers[leader]}/turnoff")
+        start = time.time()
+        alive = [server for server in self.servers if server not in (leader, follower)]
+        new_leader = None
+        while new_leader is None and time.time() - start < 30:
+            time.sleep(0.2)
+            new_leader = self.find_leader(alive)
+        election_time = time.time() - start
+        print(f"election time with one node down: {election_time:.3f}s")
+        self.assertIsNotNone(new_leader)
+
+        start = time.time()
+        response = requests.put(f"{self.servers[new_leader]}/put_data", json={"key": "foo", "value": "bar"})
+        self.assertEqual(response.json()["status"], "ok")
+        self.assertLess(time.time() - start, 1)
+
+        requests.get(f"{self.servers[follower]}/turnon")
+        requests.get(f"{self.servers[leader]}/turnon")
+        time.sleep(2)
+
+    def test_client_routes_writes_and_reads(self):
+        client = RaftClient(self.servers)
+        client.put("foo", "bar")
+        self.assertEqual(client.get("foo"), "bar")
+        client.update("foo", "baz", "bar")
+        self.assertEqual(client.get("foo"), "baz")
+
+        # the client finds the new leader on its own
+        leader = client.leader_id
+        requests.get(f"{self.servers[leader]}/turnoff")
+        client.put("foo", "qux")
+        self.assertNotEqual(client.leader_id, leader)
+        self.assertEqual(client.get("foo"), "qux")
+
+        client.delete("foo")
+        self.assertIsNone(client.get("foo"))
+
+        requests.get(f"{self.servers[leader]}/turnon")
+        time.sleep(2)
+
+
+    def test_client_does_not_resend_ambiguous_writes(self):
+        client = RaftClient(self.servers)
+        client.put("ambiguous", 0)
+        leader = client.leader_id
+        requests.get(f"{self.servers[leader]}/turnoff")
+
+        # the old leader holds the request without answering, it may still apply
+        with self.assertRaises(AmbiguousWriteError):
+            client.update("ambiguous", 1, 0)
+        # a put is safe to send again
+        client.put("ambiguous-put", 1)
+        self.assertNotEqual(client.leader_id, leader)
+
+        requests.get(f"{self.servers[leader]}/turnon")
+        time.sleep(2)
+        self.assertIn(client.get("ambiguous"), (0, 1))
+
+    def test_batch_is_atomic(self):
+        client = RaftClient(self.servers)
+        client.put("acct-a", 100)
+
+        # the delete of a missing key aborts the whole batch
+        with self.assertRaises(RaftClientError) as aborted:
+            client.batch([
+                {"op": "update", "key": "acct-a", "value": 70, "old": 100},
+                {"op": "put", "key": "acct-b", "value": 30},
+                {"op": "delete", "key": "acct-c"},
+            ])
+        self.assertEqual(
+            [result["status"] for result in aborted.exception.reply["results"]],
+            ["aborted", "aborted", "error"]
+        )
+        self.assertEqual(client.get("acct-a"), 100)
+        self.assertIsNone(client.get("acct-b"))
+
+        results = client.batch([
+            {"op": "update", "key": "acct-a", "value": 70, "old": 100},
+            {"op": "put", "key": "acct-b", "value": 30},
+            {"op": "update", "key": "acct-b", "value": 31, "old": 30},
+        ])
+        self.assertEqual(results, [{"status": "ok"}] * 3)
+        time.sleep(1)
+        for server in self.servers.values():
+            self.assertEqual(self.get_value(server, "acct-a"), 70)
+            self.assertEqual(self.get_value(server, "acct-b"), 31)
+
+    def test_conditional_updates_by_revision(self):
+        client = RaftClient(self.servers)
+        revision = client.put("rev-key", "a" * 10000)["revision"]
+        self.assertEqual(client.get_revision("rev-key"), ("a" * 10000, revision))
+
+        # the stale revision loses, no need to send the old value
+        newer = client.update("rev-key", "b", if_revision=revision)["revision"]
+        self.assertGreater(newer, revision)
+        with self.assertRaises(RaftClientError) as lost:
+            client.update("rev-key", "c", if_revision=revision)
+        self.assertEqual(str(lost.exception), "Revision has changed")
+        # 0 means the key must not exist yet
+        client.batch([{"op": "put", "key": "rev-new", "value": 1, "if_revision": 0}])
+        with self.assertRaises(RaftClientError):
+            client.batch([{"op": "put", "key": "rev-new", "value": 2, "if_revision": 0}])
+
+        # concurrent increments on one hot key: each success is exactly one step
+        client.put("rev-counter", 0)
+
+        def increment(_):
+            for _ in client.attempts():
+                value, revision = client.get_revision("rev-counter")
+                try:
+                    client.update("rev-counter", value + 1, if_revision=revision)
+                    return
+                except RaftClientError:
+                    continue
+
+        threads = [threading.Thread(target=increment, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(client.get("rev-counter"), 20)
+
+    def test_metrics_count_commits_and_forwards(self):
+        leader = self.find_leader(self.servers)
+        follower = next(server for server in self.servers if server != leader)
+        requests.put(f"{self.servers[follower]}/put_data", json={"key": "metered", "value": 1})
+
+        leader_metrics = requests.get(f"{self.servers[leader]}/metrics").text
+        follower_metrics = requests.get(f"{self.servers[follower]}/metrics").text
+        self.assertIn("raft_is_leader 1", leader_metrics)
+        self.assertIn("raft_commit_seconds_count", leader_metrics)
+        self.assertIn('raft_requests_total{route="/put_data",code="200"}', leader_metrics)
+        self.assertIn('raft_forwarded_requests_total{route="/put_data"}', follower_metrics)
+
+    def test_ttl_keys_expire_everywhere(self):
+        client = RaftClient(self.servers)
+        client.put("session-1", "token", ttl=1)
+        client.put("session-2", "token", ttl=60)
+        self.assertEqual(client.get("session-1"), "token")
+
+        time.sleep(2)
+        for server in self.servers.values():
+            self.assertIsNone(self.get_value(server, "session-1"))
+            self.assertEqual(self.get_value(server, "session-2"), "token")
+        with self.assertRaises(RaftClientError):
+            client.update("session-1", "other", "token")
+
+        # the expire entry deleted it, so post creates it afresh
+        client.post("session-1", "again")
+        self.assertEqual(client.get("session-1"), "again")
+
+    def test_scan_prefix_pages(self):
+        client = RaftClient(self.servers)
+        client.batch([{"op": "put", "key": f"user:{i:03}", "value": i} for i in range(30)])
+        client.batch([{"op": "put", "key": "users", "value": "other"}, {"op": "delete", "key": "user:010"}])
+
+        expected = [(f"user:{i:03}", i) for i in range(30) if i != 10]
+        self.assertEqual(list(client.scan("user:", page_size=7)), expected)
+        self.assertEqual(list(client.scan(start="user:025", end="user:028")), expected[24:27])
+        # a start below the prefix begins at the prefix
+        self.assertEqual(list(client.scan("user:", start="a")), expected)
+
+        # every replica serves the page itself, ending with the cursor
+        time.sleep(1)
+        for server in self.servers.values():
+            response = requests.get(f"{server}/scan", json={"prefix": "user:", "limit": 5}, allow_redirects=False)
+            if response.status_code == 302:
+                continue
+            lines = [json.loads(line) for line in response.iter_lines() if line]
+            self.assertEqual([line["key"] for line in lines[:-1]], [key for key, _ in expected[:5]])
+            self.assertEqual(lines[-1]["cursor"], "user:004")
+
+    def test_watch_streams_committed_writes(self):
+        client = RaftClient(self.servers)
+        events = []
+        watching = threading.Event()
+
+        def watch():
+            for event in RaftClient(self.servers).watch(prefix="w:"):
+                events.append(event)
+                watching.set()
+                if event["type"] == "delete":
+                    return
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        # the watch only sees writes after it connected
+        while not watching.is_set():
+            client.put("w:ready", 0)
+            watching.wait(0.5)
+        client.put("w:a", 1)
+        client.put("other", 1)
+        client.batch([{"op": "put", "key": "w:b", "value": 2}, {"op": "delete", "key": "w:a"}])
+        watcher.join(10)
+
+        self.assertEqual(
+            [(event["type"], event["key"], event.get("value")) for event in events[-3:]],
+            [("put", "w:a", 1), ("put", "w:b", 2), ("delete", "w:a", None)]
+        )
+
+        # replay a key's history from the applied log
+        history = client.watch(key="w:a", from_index=events[-3]["index"])
+        self.assertEqual(next(history)["value"], 1)
+        self.assertEqual(next(history)["type"], "delete")
+
+        # a malformed resume point is the caller's error
+        with self.assertRaises(RaftClientError):
+            next(client.watch(key="w:a", from_index="next"))
+
+    def get_value(self, server, key):
+        response = requests.get(f"{server}/get_data", json={"key": key})
+        if response.status_code == 302:
+            id = response.json().get("id")
+            response = requests.get(f"{self.servers[id]}/get_data", json={"key": key})
+        return response.json()["value"]
+
+    def test_concurrent_writes_stress(self):
+        writers, writes, incrementers, increments = 8, 25, 4, 10
+        RaftClient(self.servers).put("counter", 0)
+        errors = []
+
+        def write(n):
+            # every server, so followers forward concurrently too
+            for i in range(writes):
+                server = self.servers[(n + i) % len(self.servers) + 1]
+                response = requests.put(f"{server}/put_data", json={"key": f"stress-{n}", "value": i})
+                if response.json().get("status") != "ok":
+                    errors.append(response.json())
+
+        def increment():
+            client = RaftClient(self.servers)
+            done = 0
+            while done < increments:
+                value = client.get("counter")
+                try:
+                    client.update("counter", value + 1, value)
+                    done += 1
+                except RaftClientError:
+                    pass
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+        threads += [threading.Thread(target=increment) for _ in range(incrementers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        time.sleep(2)
+
+        # no lost updates, and every replica applied the same state
+        applied = set()
+        for server in self.servers.values():
+            self.assertEqual(self.get_value(server, "counter"), incrementers * increments)
+            for n in range(writers):
+                self.assertEqual(self.get_value(server, f"stress-{n}"), writes - 1)
+            applied.add(requests.get(f"{server}/status").json()["last_applied"])
+        self.assertEqual(len(applied), 1)
+
+
+
+class TestRaftSimulation(unittest.TestCase):
+    """Consensus scenarios on the in-process simulator: virtual time, no
+    containers, every run reproducible from its seed."""
+
+    def test_minority_leader_cannot_commit(self):
+        with Simulator(seed=1) as sim:
+            old = sim.run_until(sim.leader)
+            others = [server_id for server_id in sim.nodes if server_id != old]
+            sim.partition([old, others[0]], others[1:])
+
+            stranded = sim.propose("lost", 1)
+            new = sim.run_until(lambda: sim.leader() != old and sim.leader())
+            self.assertIn(new, others[1:])
+            kept = sim.propose("kept", 2)
+            self.assertTrue(sim.run_until(lambda: sim.committed(kept)))
+
+            sim.heal()
+            sim.run_for(30)
+            # the old leader's entry was replaced, never applied anywhere
+            for node in sim.nodes.values():
+                self.assertEqual(node.change_log.get("kept"), 2)
+                self.assertNotIn("lost", node.change_log)
+                self.assertEqual(node.last_applied, sim.nodes[new].last_applied)
+            self.assertIsNotNone(stranded)
+
+    def test_random_faults_keep_replicas_consistent(self):
+        for seed in range(20):
+            with Simulator(seed=seed, drop_rate=0.05) as sim:
+                faults = random.Random(seed)
+                for round_ in range(20):
+                    if faults.random() < 0.3:
+                        sim.crash(faults.choice(list(sim.nodes)))
+                    elif faults.random() < 0.5:
+                        for server_id in list(sim.network.down):
+                            sim.restart(server_id)
+                    for _ in range(5):
+                        sim.propose(f"key-{faults.randrange(10)}", round_)
+                    sim.run_for(faults.uniform(0.5, 8))
+
+                for server_id in list(sim.network.down):
+                    sim.restart(server_id)
+                sim.run_for(60)
+                # the simulator asserts election and state machine safety
+                # on every event; after healing everyone has caught up
+                self.assertEqual(len({node.last_applied for node in sim.nodes.values()}), 1)
+                self.assertEqual(len({json.dumps(node.change_log, sort_keys=True) for node in sim.nodes.values()}), 1)
+
+    def test_divergent_follower_backtracks_by_term(self):
+        with Simulator(seed=2) as sim:
+            old = sim.run_until(sim.leader)
+            sim.partition([old], [server_id for server_id in sim.nodes if server_id != old])
+            for i in range(3000):
+                sim.propose(f"lost-{i}", i)
+            first = sim.run_until(lambda: sim.leader() != old and sim.leader())
+            for i in range(5000):
+                sim.propose(f"kept-{i}", i)
+            self.assertTrue(sim.run_until(lambda: sim.committed(5000)))
+            # a leader that never heard of old starts it at the end of its log
+            sim.crash(first)
+            second = sim.run_until(lambda: sim.leader() not in (old, first) and sim.leader())
+
+            rejected = []
+            deliver = sim.deliver
+
+            def counting(target, path, message):
+                reply = deliver(target, path, message)
+                if target == old and path != "/vote" and not reply["success"]:
+                    rejected.append(message["prev_log_index"])
+                return reply
+
+            sim.deliver = counting
+            sim.heal()
+            self.assertTrue(sim.run_until(lambda: sim.nodes[old].last_applied == sim.nodes[second].last_applied))
+            # 3000 conflicting entries of one term are skipped at once
+            self.assertLess(len(rejected), 50)
+            self.assertNotIn("lost-0", sim.nodes[old].change_log)
+
+    def test_pre_vote_keeps_an_isolated_server_from_bumping_terms(self):
+        with Simulator(seed=4) as sim:
+            leader = sim.run_until(sim.leader)
+            term = sim.nodes[leader].term
+            loner = next(server_id for server_id in sim.nodes if server_id != leader)
+            sim.partition([loner], [server_id for server_id in sim.nodes if server_id != loner])
+            sim.run_for(60)
+            self.assertEqual(sim.nodes[loner].term, term)
+
+            sim.heal()
+            sim.run_for(10)
+            # rejoining did not depose the leader
+            self.assertEqual(sim.leader(), leader)
+            self.assertEqual(sim.nodes[leader].term, term)
+
+    def test_leadership_transfer_skips_the_election_timeout(self):
+        with Simulator(seed=5) as sim:
+            old = sim.run_until(sim.leader)
+            for i in range(100):
+                sim.propose(f"key-{i}", i)
+            target = next(server_id for server_id in sim.nodes if server_id != old)
+
+            started = sim.clock.now
+            self.assertEqual(sim.nodes[old].begin_transfer(target), target)
+            # a second transfer does not take over the running one
+            other = next(server_id for server_id in sim.nodes if server_id not in (old, target))
+            deadline = sim.nodes[old].transfer_deadline
+            self.assertIsNone(sim.nodes[old].begin_transfer(other))
+            self.assertEqual(sim.nodes[old].transfer_target, target)
+            self.assertEqual(sim.nodes[old].transfer_deadline, deadline)
+            # writes wait for the new leader
+            self.assertIsNone(sim.propose("during", 1))
+            self.assertEqual(sim.run_until(lambda: sim.leader() != old and sim.leader()), target)
+            self.assertLess(sim.clock.now - started, 0.5)
+            index = sim.propose("after", 1)
+            self.assertTrue(sim.run_until(lambda: sim.committed(index)))
+            self.assertEqual(sim.nodes[target].change_log.get("key-99"), 99)
+
+    def test_leadership_transfer_under_steady_writes_elects_the_target(self):
+        for seed in range(10):
+            with Simulator(seed=seed) as sim:
+                old = sim.run_until(sim.leader)
+                target = next(server_id for server_id in sim.nodes if server_id != old)
+                sim.nodes[old].begin_transfer(target)
+                for i in range(400):
+                    # refused until the new leader is elected
+                    sim.propose(f"key-{i}", i)
+                    sim.run_for(0.005)
+                    if sim.leader() not in (None, old):
+                        break
+                self.assertEqual(sim.leader(), target)
+
+    def test_same_seed_same_run(self):
+        def run(seed):
+            with Simulator(seed=seed, drop_rate=0.1) as sim:
+                leader = sim.run_until(sim.leader)
+                for i in range(50):
+                    sim.propose(f"key-{i}", i)
+                sim.crash(leader)
+                sim.run_for(30)
+                return [(node.term, node.state, node.last_applied) for node in sim.nodes.values()]
+
+        self.assertEqual(run(3), run(3))
+
+    def test_large_batch_checks_in_linear_time(self):
+        with Simulator(seed=8) as sim:
+            node = sim.nodes[sim.run_until(sim.leader)]
+            ops = [{"op": "put", "key": f"bulk-{i}", "value": i} for i in range(20000)]
+            with node.lock:
+                writes, _ = node.check_batch(ops)
+                node.propose({"type": "batch", "key": None, "ops": writes})
+
+            # every key's newest write is in that still pending entry
+            ops = [{"op": "update", "key": f"bulk-{i}", "value": -i, "old": i} for i in range(20000)]
+            started = time.perf_counter()
+            with node.lock:
+                writes, results = node.check_batch(ops)
+            self.assertLess(time.perf_counter() - started, 2)
+            self.assertEqual(len(writes), 20000)
+            self.assertEqual(results[-1], {"status": "ok"})
+
+
+
+class TestRaftLog(unittest.TestCase):
+
+    def test_matches_a_list_through_truncation_and_compaction(self):
+        rng = random.Random(6)
+        log, model, term = RaftLog(), [], 1
+        for step in range(2000):
+            action = rng.random()
+            if action < 0.7:
+                term += rng.random() < 0.05
+                entry = {"type": "put", "key": f"k{step}", "value": [step, "v" * rng.randrange(20)], "term": term}
+                log.append(entry)
+                model.append(entry)
+            elif action < 0.85 and len(model) > log.offset:
+                index = rng.randrange(log.offset, len(model))
+                del log[index:]
+                del model[index:]
+            elif len(model) > log.offset:
+                index = rng.randrange(log.offset, len(model) + 1)
+                log.compact(index, model[index - 1]["term"] if index else 0)
+            self.assertEqual(len(log), len(model))
+            self.assertEqual(log[log.offset:], model[log.offset:])
+            for position in range(log.offset, len(model)):
+                self.assertEqual(log.term(position), model[position]["term"])
+
+
+
+class TestFrameCodec(unittest.TestCase):
+
+    def roundtrip(self, entries):
+        message = {
+            "leader_id": 2,
+            "term": 7,
+            "prev_log_index": 1000,
+            "prev_log_term": 6,
+            "entries": entries,
+            "leader_commit": 999,
+        }
+        self.assertEqual(FrameCodec.decode(FrameCodec.encode(message)), message)
+
+    def test_entries(self):
+        self.roundtrip([
+            {"type": "put", "key": f"user:{i}", "value": f"{i}:" + "v" * i, "term": 7}
+            for i in range(50)
+        ])
+
+    def test_entries_outside_the_columns(self):
+        self.roundtrip([
+            {"type": "noop", "key": None, "term": 6},
+            {"type": "put", "key": "k\ud800\u00e9", "value": "\udfff\U0001f600", "term": 7},
+            {"type": "put", "key": "json", "value": {"nested": [1, 2.5, None]}, "term": 7},
+            {"type": "delete", "key": "gone", "term": 7},
+            {"type": "batch", "key": None, "ops": [{"op": "put", "key": "a", "value": 1}], "term": 7},
+            {"type": "expire", "key": None, "ops": [{"op": "delete", "key": "a"}], "term": 7},
+            {"type": "put", "key": "ttl", "value": 1, "expires_at": 1234.5, "term": 7},
+        ])
+
+    def test_empty_batch(self):
+        # a heartbeat
+        self.roundtrip([])
+
+
+class TestWriteAheadLog(unittest.TestCase):
+
+    def test_recover_cuts_off_a_torn_tail(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, "raft-1.wal")
+            wal = WriteAheadLog(path, sync_mode="always")
+            wal.open()
+            wal.append({"op": "term", "term": 2})
+            wal.append({"op": "vote", "term": 2, "candidate_id": 3})
+            for index in range(1, 4):
+                entry = {"type": "put", "key": f"k{index}", "value": index, "term": 2}
+                wal.append({"op": "append", "index": index, "entry": entry})
+            wal.append({"op": "commit", "index": 2})
+            wal.sync()
+            whole = os.path.getsize(path)
+            # a crash part-way through writing the last record
+            wal.append({"op": "append", "index": 4, "entry": {"type": "put", "key": "k4", "value": 4, "term": 2}})
+            wal.sync()
+            wal.file.close()
+            os.truncate(path, os.path.getsize(path) - 5)
+
+            server = RaftServer(1, data_dir=data_dir)
+            self.assertEqual(os.path.getsize(path), whole)
+            self.assertEqual(server.term, 2)
+            self.assertEqual(server.votes_by_term, {2: 3})
+            self.assertEqual([entry["key"] for entry in server.log[0:]], ["k1", "k2", "k3"])
+            self.assertEqual(server.commit_index, 2)
+            self.assertEqual(server.change_log, {"k1": 1, "k2": 2})
+            server.wal.file.close()
+
+
+class TestSnapshots(unittest.TestCase):
 
-        
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.server = RaftServer(1, data_dir=self.data_dir.name)
+
+    def tearDown(self):
+        self.server.wal.file.close()
+        self.data_dir.cleanup()
+
+    def append(self, *entries):
+        with self.server.lock:
+            for entry in entries:
+                self.server.append_entry(dict(entry, term=1))
+
+    def commit(self, index):
+        self.server.commit_index = index
+        self.server.apply_committed()
+
+    @mock.patch("server.SNAPSHOT_THRESHOLD", 100)
+    @mock.patch("server.SNAPSHOT_TRAILING_ENTRIES", 10)
+    def test_deleted_keys_leave_the_key_index(self):
+        for i in range(2000):
+            self.append({"type": "put", "key": f"k{i}", "value": i}, {"type": "delete", "key": f"k{i}"})
+        self.append({"type": "put", "key": "kept", "value": 1})
+        self.commit(len(self.server.log))
+        self.server.take_snapshot()
+        self.assertEqual(self.server.change_log, {"kept": 1})
+        self.assertEqual(list(self.server.key_index), ["kept"])
+        self.assertEqual(self.server.write_slots, {})
+
+    @mock.patch("server.SNAPSHOT_THRESHOLD", 1)
+    def test_restore_indexes_the_log_kept_past_the_snapshot(self):
+        self.append({"type": "put", "key": "a", "value": 1}, {"type": "put", "key": "b", "value": 1})
+        self.commit(2)
+        self.server.take_snapshot()
+        self.append(
+            {"type": "put", "key": "a", "value": 2},
+            {"type": "batch", "key": None, "ops": [
+                {"type": "put", "key": "c", "value": 3},
+                {"type": "put", "key": "b", "value": 2},
+            ]},
+        )
+
+        self.server.restore_snapshot(json.loads(self.server.snapshots.load()))
+        self.assertEqual(len(self.server.log), 4)
+        self.assertEqual(self.server.key_index, {"a": 3, "b": 4, "c": 4})
+        self.assertEqual(self.server.write_slots, {"b": 1, "c": 0})
+        self.assertEqual(self.server.latest_value("b"), 2)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RaftServer(1, data_dir=None)
+        self.server.state = "leader"
+
+    def test_malformed_ops_get_a_400(self):
+        client = self.server.app.test_client()
+        for body in ({"ops": "put"}, {"ops": [1]}, {"ops": [{"key": "a"}]}, {"ops": [{"op": "put"}]}, [1]):
+            self.assertEqual(client.post("/batch", json=body).status_code, 400)
+
+    def test_null_if_revision_is_not_compared(self):
+        with self.server.lock:
+            writes, results = self.server.check_batch([{"op": "put", "key": "a", "value": 1, "if_revision": None}])
+        self.assertEqual(results, [{"status": "ok"}])
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_keys_come_due_in_the_slot_they_expire_in(self):
+        wheel = TimerWheel(resolution=1)
+        wheel.schedule("a", 10.5)
+        wheel.schedule("b", 12.2)
+        self.assertEqual(wheel.advance(9), [])
+        self.assertEqual(wheel.advance(10.9), ["a"])
+        self.assertEqual(wheel.advance(11), [])
+        # a deadline already passed comes due on the next advance
+        wheel.schedule("c", 5)
+        self.assertEqual(sorted(wheel.advance(12.5)), ["b", "c"])
+        self.assertEqual(wheel.advance(1000), [])
+
+    def test_fresh_wheel_with_a_far_future_key_expires_short_ttls_on_time(self):
+        # as rebuilt by a restart or a snapshot install
+        now = 1000
+        wheel = TimerWheel(resolution=1)
+        wheel.schedule("hour", now + 3600)
+        self.assertEqual(wheel.advance(now), [])
+        wheel.schedule("second", now + 1)
+        self.assertEqual(wheel.advance(now + 2), ["second"])
+        self.assertEqual(wheel.advance(now + 3601), ["hour"])
 
 
 if __name__ == "__main__":